@@ -8,13 +8,17 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from models import User, DEFAULT_DISPLAY_PICTURE
+from queue_metrics import take_enqueue_times, record_processed, ADMIN_REQUESTS
+from email_queue import enqueue_confirmation
+from payloads import pack, unpack, unpack_with_meta, ADMIN_REQUEST
+from password_hasher import password_hasher, hash_password
+from reservations import confirm_identity, release_identity
 from sqlalchemy.exc import InvalidRequestError, ProgrammingError, IntegrityError
 from threading import Thread
 from datetime import datetime
 import os
 import redis
 import time
-import json
 
 
 cache_pass, port_number = os.environ.get('redis_pass'), int(os.environ.get('redis_port'))
@@ -23,7 +27,7 @@ data_cache = redis.StrictRedis(password=cache_pass, port=port_number)
 sleep_time = 60
 admin_request_key = 'tuq:admin_requests'
 failures_key = 'tuq:admin_request_fails'
-pending_email_keys = 'tuq:pending_confirmation_emails'
+scan_count = int(os.environ.get('ADMIN_BROKER_BATCH_SIZE', 100))
 
 
 def create_app():
@@ -35,17 +39,63 @@ def create_app():
     return application
 
 
-def save_to_database(user_info, db_connector):
-    this_user = User(fullname=user_info.get('fullname'), address=user_info.get('address'),
-                     email=user_info.get('email'), phone_number=user_info.get('mobile'),
-                     is_active_premium=False,is_confirmed=False, role=User.ADMINISTRATOR,
-                     display_picture=DEFAULT_DISPLAY_PICTURE, username=user_info.get('username'),
-                     alias=user_info.get('alias'), password=user_info.get('password'),
-                     date_of_registration = str(datetime.utcnow()),
-                     other_info='Nationality: {}'.format(user_info.get('nationality')))
-    db_connector.session.add(this_user)
-    db_connector.session.commit()
-    return True, this_user.id
+def new_administrator(user_info):
+    return User(fullname=user_info.get('fullname'), address=user_info.get('address'),
+                email=user_info.get('email'), phone_number=user_info.get('mobile'),
+                is_active_premium=False,is_confirmed=False, role=User.ADMINISTRATOR,
+                display_picture=DEFAULT_DISPLAY_PICTURE, username=user_info.get('username'),
+                alias=user_info.get('alias'), password_hash=user_info.get('password_hash'),
+                date_of_registration = str(datetime.utcnow()),
+                other_info='Nationality: {}'.format(user_info.get('nationality')))
+
+
+def hash_legacy_passwords(requests, logger):
+    """
+    Requests queued before the web tier hashed passwords still carry them in plain text. They are
+    hashed, and their payloads re-packed without the password, so a request that fails is parked
+    in tuq:admin_request_fails without it.
+    """
+    legacy = [index for index, (_, _, info) in enumerate(requests)
+              if not info.get('password_hash') and info.get('password')]
+    passwords = [requests[index][2].get('password') for index in legacy]
+    try:
+        password_hashes = password_hasher.hash_many(passwords)
+    except Exception as exc:
+        logger.write('{}: Password pool unavailable, hashing inline: {}\n'.format(datetime.utcnow(), str(exc)))
+        password_hashes = [hash_password(password) for password in passwords]
+    for index, password_hash in zip(legacy, password_hashes):
+        user_key, data, info = requests[index]
+        info['password_hash'], info['password'] = password_hash, None
+        requests[index] = (user_key, pack(ADMIN_REQUEST, info, unpack_with_meta(ADMIN_REQUEST, data)[1]), info)
+
+
+def insert_administrators(requests, db_connector, logger):
+    """
+    Creates the administrators of a batch in one transaction. If the batch is rejected, it is
+    retried one request at a time so only the offending requests fail.
+    :return: a tuple of the saved requests, each with its new user, and the failed requests.
+    """
+    users = [new_administrator(info) for _, _, info in requests]
+    try:
+        db_connector.session.add_all(users)
+        db_connector.session.commit()
+        return [request + (user,) for request, user in zip(requests, users)], []
+    except Exception as exc:
+        db_connector.session.rollback()
+        logger.write('{}: Batch of {} admin requests rejected, retrying one by one: {}\n'.format(
+            datetime.utcnow(), len(requests), str(exc)))
+    saved, failed = [], []
+    for request in requests:
+        user = new_administrator(request[2])
+        try:
+            db_connector.session.add(user)
+            db_connector.session.commit()
+            saved.append(request + (user,))
+        except Exception as exc:
+            db_connector.session.rollback()
+            logger.write('Error ocurred[{}]: {}\n'.format(datetime.utcnow(),str(exc)))
+            failed.append(request)
+    return saved, failed
 
 
 app = create_app()
@@ -53,32 +103,53 @@ db = SQLAlchemy()
 db.init_app(app)
 
 
+def process_admin_requests(admin_requests, logger):
+    """
+    Saves one HSCAN batch of admin requests; every Redis side effect of the batch goes out in a
+    single pipeline.
+    """
+    enqueue_times = take_enqueue_times(data_cache, ADMIN_REQUESTS, list(admin_requests.keys()))
+    pipe = data_cache.pipeline(transaction=False)
+    requests, failed = [], []
+    for user_key, data in admin_requests.items():
+        try:
+            requests.append((user_key, data, unpack(ADMIN_REQUEST, data)))
+        except ValueError as exc:
+            logger.write('Error ocurred[{}]: {}\n'.format(datetime.utcnow(),str(exc)))
+            failed.append((user_key, data, None))
+    hash_legacy_passwords(requests, logger)
+    with app.app_context():
+        saved, rejected = insert_administrators(requests, db, logger) if requests else ([], [])
+        for user_key, data, this_user_info, user in saved:
+            email = this_user_info.get('email')
+            confirm_identity(pipe, this_user_info.get('username'), email, this_user_info.get('mobile'),
+                             this_user_info.get('reservation') or '')
+            enqueue_confirmation(pipe, email, user.id, this_user_info.get('fullname'))
+    for user_key, data, this_user_info in failed + rejected:
+        pipe.hset(failures_key, user_key, data)
+        if this_user_info is not None and this_user_info.get('reservation'):
+            release_identity(pipe, this_user_info.get('username'), this_user_info.get('email'),
+                             this_user_info.get('mobile'), this_user_info.get('reservation'))
+    pipe.hdel(admin_request_key, *admin_requests.keys())
+    record_processed(pipe, ADMIN_REQUESTS, enqueue_times, len(failed) + len(rejected))
+    pipe.execute()
+
+
 def main(logger):
     time.sleep(10)
     while True:
-        user_keys = data_cache.hgetall(admin_request_key).keys()
-        logger.write('Keys: {}\n'.format(str(user_keys)))
-        if len(user_keys) == 0:
+        cursor, processed = 0, 0
+        while True:
+            cursor, admin_requests = data_cache.hscan(admin_request_key, cursor, count=scan_count)
+            if len(admin_requests) != 0:
+                logger.write('Keys: {}\n'.format(str(list(admin_requests.keys()))))
+                process_admin_requests(admin_requests, logger)
+                processed += len(admin_requests)
+            if cursor == 0:
+                break
+        if processed == 0:
             logger.flush()
             time.sleep(sleep_time)
-        for user_key in user_keys:
-            data = data_cache.hget(admin_request_key, user_key)
-            this_user_info = json.loads(data)
-            try:
-                with app.app_context():
-                    result, user_id = save_to_database(this_user_info, db)
-                    email = this_user_info.get('email')
-                    phone_number = this_user_info.get('mobile')
-                    data_cache.sadd('tuq:usernames', this_user_info.get('username'))
-                    data_cache.sadd('tuq:emails', email)
-                    if phone_number is not None and data_cache.sismember('tuq:phones',phone_number):
-                        data_cache.sadd('tuq:phones', phone_number)
-                    data_cache.hset(pending_email_keys, email, 
-                            '{} %% {}'.format(user_id, this_user_info.get('fullname')))
-            except Exception as exc:
-                logger.write('Error ocurred[{}]: {}\n'.format(datetime.utcnow(),str(exc)))
-                data_cache.hset(failures_key, user_key, data)
-            data_cache.hdel(admin_request_key, user_key)
 
 
 event_logger = open('./logs.txt', 'a')
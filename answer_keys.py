@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  answer_keys.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from models import Course
+from threading import Thread, Lock
+import numpy
+import json
+import os
+import time
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+
+# course_id -> counter, bumped by the web tier whenever a course's key is edited or the course removed
+answer_key_versions = 'tuq:answer_key_versions'
+# courses waiting for a web worker's warmer thread; requests asking for more are not queued
+warm_queue_size = 64
+# answers are marked as int32; one outside this range cannot be an option index
+answer_range = numpy.iinfo(numpy.int32)
+
+
+def invalidate_answer_key(data_cache, course_id):
+    data_cache.hincrby(answer_key_versions, course_id, 1)
+
+
+def solution_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def answers_to_row(course_data, user_solution_array):
+    """
+    :param user_solution_array: should be an array of index integers with length
+    EXACTLY == solutions data length.
+    :param course_data: should be the cached answer key of the course to be marked,
+    including its unique ID.
+    :raises ValueError, TypeError or OverflowError (e.g. for an answer of 1e400) for a paper that
+    cannot be marked.
+    """
+    if len(course_data.solution) != len(user_solution_array):
+        raise ValueError('Unequal data length for course {} with ID: {}'
+                         .format(course_data.name, course_data.id))
+    row = [int(answer) for answer in user_solution_array]
+    if any(answer < answer_range.min or answer > answer_range.max for answer in row):
+        raise ValueError('Answer out of range for course {} with ID: {}'.format(course_data.name, course_data.id))
+    return row
+
+
+def mark_papers(course_data, user_solution_matrix):
+    """
+    :param user_solution_matrix: 2-D integer array, one row per submission, built from
+    rows returned by answers_to_row.
+    :return: a tuple of the per-row scores and the total score obtainable.
+    """
+    return numpy.count_nonzero(user_solution_matrix == course_data.solution, axis=1), len(course_data.solution)
+
+
+def mark_paper(course_data, user_solution_array):
+    row = answers_to_row(course_data, user_solution_array)
+    scores, arity = mark_papers(course_data, numpy.array([row], dtype=numpy.int32))
+    return int(scores[0]), arity
+
+
+class AnswerKey(object):
+    def __init__(self, course, solution, mtime, version):
+        self.id = course.id
+        self.name = course.name
+        self.solution_filename = course.solution_filename
+        self.quiz_filename = course.quiz_filename
+        self.solution = solution
+        self.mtime = mtime
+        self.version = version
+
+    def __len__(self):
+        return len(self.solution)
+
+    def __repr__(self):
+        return '<AnswerKey ==> ID: {}, arity: {}>'.format(self.id, len(self.solution))
+
+
+class AnswerKeyCache(object):
+    """
+    In-process cache of parsed answer keys, keyed by course id. An entry is reloaded when the
+    solution file's mtime changes or when the course's counter in `answer_key_versions` moves.
+    """
+    def __init__(self, database_handle, data_cache):
+        self.database_handle = database_handle
+        self.data_cache = data_cache
+        self.keys = {}
+        self.versions = {}
+        self.refreshed_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    def refresh_versions(self, max_age=None):
+        # one HGETALL per marking pass instead of one round trip per paper; web workers pass
+        # max_age so a burst of requests shares one refresh
+        if max_age is not None and time.time() - self.refreshed_at < max_age:
+            return
+        versions = self.data_cache.hgetall(answer_key_versions)
+        self.versions = dict((int(course_id), int(version)) for course_id, version in versions.items())
+        self.refreshed_at = time.time()
+
+    def is_fresh(self, answer_key):
+        return answer_key.version == self.versions.get(answer_key.id, 0) and \
+            answer_key.mtime == solution_mtime(answer_key.solution_filename)
+
+    def get(self, course_id):
+        answer_key = self.keys.get(course_id)
+        if answer_key is not None and self.is_fresh(answer_key):
+            self.hits += 1
+            return answer_key
+        self.misses += 1
+        self.keys.pop(course_id, None)
+        answer_key = self.load(course_id)
+        self.keys[course_id] = answer_key
+        return answer_key
+
+    def peek(self, course_id):
+        answer_key = self.keys.get(course_id)
+        if answer_key is None or not self.is_fresh(answer_key):
+            return None
+        return answer_key
+
+    def load(self, course_id):
+        course = self.database_handle.session.query(Course).filter_by(id=course_id).first()
+        if course is None:
+            raise ValueError('Course data is \'None\' for ID: {}'.format(course_id))
+        mtime = solution_mtime(course.solution_filename)
+        with open(course.solution_filename, 'r') as solution_file:
+            solution_data = json.load(solution_file)
+        solution = numpy.array([int(answer) for answer in solution_data], dtype=numpy.int32)
+        return AnswerKey(course, solution, mtime, self.versions.get(course.id, 0))
+
+    def invalidate(self, course_id):
+        self.keys.pop(course_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.keys)}
+
+
+class AnswerKeyWarmer(object):
+    """
+    Loads answer keys into an AnswerKeyCache from a daemon thread, so the request that found a
+    course's key cold does not wait on MySQL and the solution file. The thread is started on
+    first use in each process, so forked web workers get their own.
+    """
+    def __init__(self, answer_keys, max_pending=warm_queue_size):
+        self.answer_keys = answer_keys
+        self.pending = Queue(max_pending)
+        self.queued = set()
+        self.lock = Lock()
+        self.worker_pid = None
+
+    def ensure_worker(self, app):
+        if self.worker_pid == os.getpid():
+            return
+        with self.lock:
+            if self.worker_pid != os.getpid():
+                worker = Thread(target=self.run, args=(app,))
+                worker.setName('AnswerKeyWarmer')
+                worker.setDaemon(True)
+                worker.start()
+                self.worker_pid = os.getpid()
+
+    def warm(self, app, course_id):
+        """Queues the course's key for loading unless it is already queued or the queue is full."""
+        self.ensure_worker(app)
+        with self.lock:
+            if course_id in self.queued:
+                return
+            try:
+                self.pending.put_nowait(course_id)
+            except Full:
+                return
+            self.queued.add(course_id)
+
+    def run(self, app):
+        while True:
+            course_id = self.pending.get()
+            try:
+                with app.app_context():
+                    self.answer_keys.get(course_id)
+            except Exception as exc:
+                print('Unable to cache answer key for {}: {}'.format(course_id, str(exc)))
+            finally:
+                with self.lock:
+                    self.queued.discard(course_id)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  benchmark_email_logger.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from __future__ import print_function
+from email_logger import initialize_channel, initialize_email_receiver, LogSink, BatchingLogConsumer
+from email_logger import EXCHANGE_NAME
+import argparse
+import tempfile
+import time
+import os
+
+
+def publish(channel, count, size):
+    line = (b'x' * (size - 1)) + b'\n'
+    for _ in range(count):
+        channel.basic_publish(exchange=EXCHANGE_NAME, routing_key='benchmark.log', body=line)
+    channel.basic_publish(exchange=EXCHANGE_NAME, routing_key='benchmark.log', body=b'quit')
+
+
+def main(count, size, prefetch_count):
+    """Fills the log queue of a local RabbitMQ, then times how long the consumer takes to drain it."""
+    channel = initialize_channel()
+    initialize_email_receiver(channel)
+    publish(channel, count, size)
+    directory = tempfile.mkdtemp()
+    sink = LogSink(os.path.join(directory, 'email_log_file.txt'))
+    started = time.time()
+    try:
+        BatchingLogConsumer(channel, sink, prefetch_count=prefetch_count).start()
+    finally:
+        sink.close()
+    elapsed = time.time() - started
+    print('{} messages of {} bytes in {:.2f}s: {:.0f} messages/s (prefetch {}, log in {})'.format(
+        count, size, elapsed, count / elapsed, prefetch_count, directory))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures email log consumer throughput against a local RabbitMQ')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=200, help='bytes per log line')
+    parser.add_argument('--prefetch', type=int, default=1000)
+    arguments = parser.parse_args()
+    main(arguments.messages, arguments.size, arguments.prefetch)
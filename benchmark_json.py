@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  benchmark_json.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from __future__ import print_function
+from flask import Flask, jsonify
+from flask.json import JSONEncoder
+from datetime import datetime
+from random import randint
+import argparse
+import timeit
+import json
+import json_codec
+
+
+def sample_payloads(questions):
+    """
+    Payloads shaped like the app's: a submitted answer array, a course listing, a quiz file and
+    exam results, whose datetimes go through the encoder's default().
+    """
+    answers = [randint(0, 4) for _ in range(questions)]
+    listing = {'status': 1, 'cacheable': True, 'exams': [
+        {'id': index, 'name': 'Course {}'.format(index), 'owner': 'lecturer', 'code': 'CSC{}'.format(index),
+         'date_to_be_held': '2017-06-01', 'duration': 60, 'departments': ['Computer Science', 'Physics']}
+        for index in range(200)]}
+    quiz = {'questions': [{'question': 'Question number {}?'.format(index),
+                           'options': ['Option {}'.format(option) for option in range(5)]}
+                          for index in range(questions)]}
+    results = {'status': 1, 'results': [{'course_id': index, 'score': randint(0, 50), 'total': 50,
+                                         'date_taken': datetime(2017, 6, 1, 10, index % 60)}
+                                        for index in range(200)]}
+    return {'answers': answers, 'listing': listing, 'quiz': quiz, 'results': results}
+
+
+def jsonify_in(app):
+    # with pretty printing off jsonify never looks at the request, so an app context is enough
+    def encode(obj):
+        with app.app_context():
+            return jsonify(obj).get_data(as_text=True)
+    return encode
+
+
+def encoders():
+    """The app's encoding before json_codec, and the code it ships: json_codec itself and jsonify."""
+    flask_app, codec_app = Flask('flask_json'), Flask('json_codec')
+    flask_app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    json_codec.init_app(codec_app)
+    encoder = JSONEncoder()
+    return {'json': (lambda obj: json.dumps(obj, default=encoder.default, separators=(',', ':')), json.loads),
+            'json_codec': (json_codec.dumps, json_codec.loads),
+            'jsonify (flask)': (jsonify_in(flask_app), json.loads),
+            'jsonify (codec)': (jsonify_in(codec_app), json_codec.loads)}
+
+
+def main(questions, rounds):
+    payloads = sample_payloads(questions)
+    codecs = encoders()
+    print('json_codec backend: {}'.format(json_codec.backend))
+    print('{:<16} {:<10} {:>12} {:>12} {:>10}'.format('codec', 'payload', 'dumps (us)', 'loads (us)', 'bytes'))
+    timings = {}
+    for name in sorted(payloads):
+        payload = payloads[name]
+        for codec_name in sorted(codecs):
+            dumps, loads = codecs[codec_name]
+            text = dumps(payload)
+            dump_time = min(timeit.repeat(lambda: dumps(payload), number=rounds, repeat=3)) / rounds
+            load_time = min(timeit.repeat(lambda: loads(text), number=rounds, repeat=3)) / rounds
+            timings[codec_name, name] = dump_time
+            print('{:<16} {:<10} {:>12.1f} {:>12.1f} {:>10}'.format(codec_name, name, dump_time * 1e6,
+                                                                    load_time * 1e6, len(text)))
+    for name in sorted(payloads):
+        print('{:<10} json_codec {:.1f}x faster than json, jsonify {:.1f}x faster with the codec'.format(
+            name, timings['json', name] / timings['json_codec', name],
+            timings['jsonify (flask)', name] / timings['jsonify (codec)', name]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the JSON encoding the app ships with the one it replaced')
+    parser.add_argument('--questions', type=int, default=500, help='questions per quiz and answer array')
+    parser.add_argument('--rounds', type=int, default=200)
+    arguments = parser.parse_args()
+    main(arguments.questions, arguments.rounds)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  course_cache.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from resources import well_known_courses
+from lua_scripts import LuaScript
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+from uuid import uuid4
+import json_codec
+import time
+import os
+
+
+# bumped on every invalidation of a course, and of the '*' field on every invalidation of them all
+course_versions_key = 'tuq:known_course_versions'
+course_loading_format = 'tuq:course_loading:{course_id}'
+# course ids published here are dropped from every worker's local cache; '*' drops everything
+invalidation_channel = 'tuq:course_invalidations'
+local_capacity = int(os.environ.get('COURSE_CACHE_SIZE', 1024))
+local_ttl = float(os.environ.get('COURSE_CACHE_TTL', 30))
+# while another process loads a course from MySQL, wait this long for it to land in Redis
+load_wait = 1.0
+load_poll_interval = 0.05
+# entries cached by older code lack some of these and are reloaded
+required_fields = ('id', 'name', 'code', 'owner', 'owner_username', 'icon', 'question', 'solution',
+                   'duration', 'randomize', 'departments')
+
+# KEYS[1] = known courses, KEYS[2] = course versions; ARGV[1] = course id, ARGV[2] = course,
+# ARGV[3] = version of the course and ARGV[4] = version of '*' read before loading it
+# returns 1 if the course was stored, 0 if it was invalidated while it was loaded
+store_course = LuaScript("""
+local versions = redis.call('HMGET', KEYS[2], ARGV[1], '*')
+if (versions[1] or '0') ~= ARGV[3] or (versions[2] or '0') ~= ARGV[4] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return 1
+""")
+
+# KEYS[1] = loading lock; ARGV[1] = token of the holder
+release_lock = LuaScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def course_metadata(course, owner_username):
+    return {'id': course.id, 'name': course.name, 'code': course.code, 'owner': course.lecturer_in_charge,
+            'owner_username': owner_username, 'icon': course.logo_location, 'question': course.quiz_filename,
+            'solution': course.solution_filename, 'duration': course.duration_in_minutes,
+            'randomize': course.randomize_questions,
+            'departments': [department.name for department in course.departments if len(department.name) != 0]}
+
+
+def announce_course_change(client, course_id='*'):
+    """Bumps the course's version, so loads already under way are not stored, and tells every worker."""
+    client.hincrby(course_versions_key, course_id, 1)
+    client.publish(invalidation_channel, course_id)
+
+
+def invalidate_course(data_cache, course_id='*'):
+    """Drops a course (every course by default) from Redis and from every worker's local cache."""
+    pipe = data_cache.pipeline()
+    if course_id == '*':
+        pipe.delete(well_known_courses)
+    else:
+        pipe.hdel(well_known_courses, course_id)
+    announce_course_change(pipe, course_id)
+    pipe.execute()
+
+
+def decode_course(value):
+    if value is None:
+        return None
+    course = json_codec.loads(value)
+    return course if all(field in course for field in required_fields) else None
+
+
+class LocalCache(object):
+    """A bounded least-recently-used map whose entries also expire after `ttl` seconds."""
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class Flight(object):
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.failed = True
+
+
+class CourseCache(object):
+    """
+    Course metadata from a local LRU, then the tuq:known_courses hash, then MySQL through
+    `load_course(course_id)`. Concurrent misses for one course in a worker share a single load, and
+    a Redis lock keeps other workers from querying MySQL for it at the same time. Each process
+    subscribes to tuq:course_invalidations on first use, so forked workers get their own listener.
+    """
+    def __init__(self, data_cache, load_course, capacity=local_capacity, ttl=local_ttl):
+        self.data_cache = data_cache
+        self.load_course = load_course
+        self.local = LocalCache(capacity, ttl)
+        self.lock = Lock()
+        self.flights = {}
+        self.invalidations = 0
+        self.listener_pid = None
+
+    def ensure_listener(self):
+        if self.listener_pid == os.getpid():
+            return
+        with self.lock:
+            if self.listener_pid != os.getpid():
+                self.local.clear()
+                listener = Thread(target=self.listen)
+                listener.setName('CourseCacheInvalidations')
+                listener.setDaemon(True)
+                listener.start()
+                self.listener_pid = os.getpid()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.data_cache.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(invalidation_channel)
+                for message in pubsub.listen():
+                    self.drop(message['data'].decode('utf-8'))
+            except Exception as exc:
+                print('Course invalidation listener restarting: {}'.format(str(exc)))
+            # invalidations sent while we were not listening are lost, so start afresh
+            self.drop('*')
+            time.sleep(1)
+
+    def drop(self, course_id):
+        with self.lock:
+            self.invalidations += 1
+        if course_id == '*':
+            self.local.clear()
+        else:
+            self.local.discard(int(course_id))
+
+    def get(self, course_id):
+        """:return: the course's metadata as a dict, or None if there is no such course."""
+        course_id = int(course_id)
+        self.ensure_listener()
+        course = self.local.get(course_id)
+        if course is not None:
+            return course
+        with self.lock:
+            flight = self.flights.get(course_id)
+            leader = flight is None
+            if leader:
+                flight = self.flights[course_id] = Flight()
+            invalidations = self.invalidations
+        if not leader:
+            if flight.event.wait(load_wait * 2) and not flight.failed:
+                return flight.value
+            return self.load(course_id)
+        try:
+            flight.value = self.load(course_id)
+            flight.failed = False
+            with self.lock:
+                current = self.invalidations == invalidations
+            if flight.value is not None and current:
+                self.local.put(course_id, flight.value)
+            return flight.value
+        finally:
+            with self.lock:
+                del self.flights[course_id]
+            flight.event.set()
+
+    def get_many(self, course_ids):
+        """Looks up several courses with one HMGET for those missing locally; order is kept."""
+        self.ensure_listener()
+        courses = [self.local.get(int(course_id)) for course_id in course_ids]
+        missing = [index for index, course in enumerate(courses) if course is None]
+        if len(missing) != 0:
+            values = self.data_cache.hmget(well_known_courses, [course_ids[index] for index in missing])
+            for index, value in zip(missing, values):
+                courses[index] = decode_course(value)
+                if courses[index] is not None:
+                    self.local.put(int(course_ids[index]), courses[index])
+                else:
+                    courses[index] = self.get(course_ids[index])
+        return courses
+
+    def load(self, course_id):
+        """
+        Loads a course missing from Redis and stores it, unless it was invalidated in the meantime:
+        its version is read before the query and compared when storing.
+        """
+        pipe = self.data_cache.pipeline(transaction=False)
+        pipe.hget(well_known_courses, course_id)
+        pipe.hmget(course_versions_key, [course_id, '*'])
+        value, versions = pipe.execute()
+        course = decode_course(value)
+        if course is not None:
+            return course
+        lock_key, token = course_loading_format.format(course_id=course_id), uuid4().hex
+        locked = self.data_cache.set(lock_key, token, nx=True, ex=int(load_wait * 5))
+        if not locked:
+            waited = 0.0
+            while waited < load_wait:
+                time.sleep(load_poll_interval)
+                waited += load_poll_interval
+                course = decode_course(self.data_cache.hget(well_known_courses, course_id))
+                if course is not None:
+                    return course
+        try:
+            course = self.load_course(course_id)
+            if course is not None:
+                store_course(self.data_cache, [well_known_courses, course_versions_key],
+                             [course_id, json_codec.dumps(course)] + [version or 0 for version in versions])
+            return course
+        finally:
+            if locked:
+                release_lock(self.data_cache, [lock_key], [token])
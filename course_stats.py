@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  course_stats.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from models import ExamTaken
+from lua_scripts import LuaScript
+from rebuild_cache import KeySwap, streamed
+from itertools import chain
+from sqlalchemy import func
+from datetime import datetime
+import argparse
+import math
+
+
+course_stats_format = 'tuq:course_stats:{course_id}'
+# field '<score>/<total_score>' -> number of papers with that score
+course_histogram_format = 'tuq:course_histogram:{course_id}'
+
+# KEYS[1] = stats, KEYS[2] = histogram
+# ARGV = count, sum, sum of squares, min, max, then (histogram field, increment) pairs.
+# A negative count removes scores; min and max are left alone then, as they cannot be recovered.
+update_stats_script = """
+redis.call('HINCRBY', KEYS[1], 'count', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'sum', ARGV[2])
+redis.call('HINCRBY', KEYS[1], 'sum_squares', ARGV[3])
+if tonumber(ARGV[1]) > 0 then
+    local current = redis.call('HGET', KEYS[1], 'min')
+    if not current or tonumber(ARGV[4]) < tonumber(current) then
+        redis.call('HSET', KEYS[1], 'min', ARGV[4])
+    end
+    current = redis.call('HGET', KEYS[1], 'max')
+    if not current or tonumber(ARGV[5]) > tonumber(current) then
+        redis.call('HSET', KEYS[1], 'max', ARGV[5])
+    end
+end
+for i = 6, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1]) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+end
+return 1
+"""
+update_stats = LuaScript(update_stats_script)
+
+
+def histogram_field(score, total):
+    return '{}/{}'.format(score, total)
+
+
+def record_scores(data_cache, course_id, scores, sign=1):
+    """
+    Folds a group of (score, total) pairs into the course's running aggregates with one script
+    call; data_cache may be a pipeline. Pass sign=-1 to take scores back out.
+    """
+    if len(scores) == 0:
+        return
+    histogram = {}
+    for score, total in scores:
+        field = histogram_field(score, total)
+        histogram[field] = histogram.get(field, 0) + sign
+    arguments = [sign * len(scores), sign * sum(score for score, _ in scores),
+                 sign * sum(score * score for score, _ in scores),
+                 min(score for score, _ in scores), max(score for score, _ in scores)]
+    for field, increment in histogram.items():
+        arguments.extend([field, increment])
+    update_stats(data_cache, [course_stats_format.format(course_id=course_id),
+                              course_histogram_format.format(course_id=course_id)], arguments)
+
+
+def get_course_stats(data_cache, course_id):
+    pipe = data_cache.pipeline(transaction=False)
+    pipe.hgetall(course_stats_format.format(course_id=course_id))
+    pipe.hgetall(course_histogram_format.format(course_id=course_id))
+    stats, histogram = pipe.execute()
+    count = int(stats.get(b'count', 0))
+    if count <= 0:
+        return {'count': 0, 'mean': None, 'std_dev': None, 'min': None, 'max': None, 'histogram': []}
+    total, total_squares = float(stats.get(b'sum', 0)), float(stats.get(b'sum_squares', 0))
+    mean = total / count
+    distribution = []
+    for field, frequency in histogram.items():
+        score, total_score = field.decode('utf-8').split('/')
+        distribution.append({'score': int(score), 'total': int(total_score), 'count': int(frequency)})
+    distribution.sort(key=lambda bucket: (bucket['total'], bucket['score']))
+    return {'count': count, 'mean': mean, 'std_dev': math.sqrt(max(total_squares / count - mean * mean, 0.0)),
+            'min': int(stats[b'min']) if b'min' in stats else None,
+            'max': int(stats[b'max']) if b'max' in stats else None, 'histogram': distribution}
+
+
+def rebuild_course_stats(data_cache, database_handle):
+    """
+    Recomputes every course's aggregates and histogram from exams_taken, grouped by score in
+    MySQL, through a KeySwap. Scores recorded while it runs are lost in the swap, so run it
+    outside exam windows.
+    """
+    rows = streamed(database_handle.session.query(ExamTaken.course_id, ExamTaken.score, ExamTaken.total_score,
+                                                  func.count(ExamTaken.id))
+                    .group_by(ExamTaken.course_id, ExamTaken.score, ExamTaken.total_score))
+    swap, stats = KeySwap(data_cache), {}
+    for course_id, score, total, papers in rows:
+        course = stats.setdefault(course_id, {'count': 0, 'sum': 0, 'sum_squares': 0, 'min': score, 'max': score})
+        course['count'] += papers
+        course['sum'] += score * papers
+        course['sum_squares'] += score * score * papers
+        course['min'], course['max'] = min(course['min'], score), max(course['max'], score)
+        swap.write('hset', course_histogram_format.format(course_id=course_id), histogram_field(score, total), papers)
+    for course_id, course in stats.items():
+        swap.write('hmset', course_stats_format.format(course_id=course_id), course)
+    swap.swap(chain(data_cache.scan_iter(match=course_stats_format.format(course_id='*')),
+                    data_cache.scan_iter(match=course_histogram_format.format(course_id='*'))))
+    return len(stats)
+
+
+if __name__ == '__main__':
+    from init_file import create_app
+    from resources import data_cache
+    from models import db
+
+    parser = argparse.ArgumentParser(description='Maintains the per-course score statistics kept in Redis')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+    with create_app().app_context():
+        print('{}: Rebuilt statistics of {} courses'.format(datetime.utcnow(), rebuild_course_stats(data_cache, db)))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  dead_letters.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from paper_queue import requeue_paper
+from rate_limiter import TokenBucket
+from queue_metrics import record_enqueued, ADMIN_REQUESTS
+from payloads import pack, unpack, unpack_with_meta, PAPER, ADMIN_REQUEST
+from password_hasher import hash_password
+from lua_scripts import LuaScript
+from datetime import datetime
+import argparse
+import random
+import redis
+import json
+import time
+import sys
+import os
+
+
+cache_pass, port_number = os.environ.get('redis_pass'), int(os.environ.get('redis_port'))
+data_cache = redis.StrictRedis(password=cache_pass, port=port_number)
+admin_request_key = 'tuq:admin_requests'
+# items are retried after base_delay * 2 ** attempts seconds (capped at max_delay), half of it jittered
+base_delay = float(os.environ.get('REPLAY_BASE_DELAY', 30))
+max_delay = float(os.environ.get('REPLAY_MAX_DELAY', 60 * 60))
+max_attempts = int(os.environ.get('REPLAY_MAX_ATTEMPTS', 8))
+# items replayed per second at most, so a backlog left by an outage does not stampede MySQL
+replay_rate = float(os.environ.get('REPLAY_RATE', 20))
+replay_batch_size = 100
+scan_interval = 10
+tick_interval = 1
+
+# KEYS[1] = hash; ARGV = field, expected payload, new payload. Leaves a field that changed meanwhile alone.
+replace_payload = LuaScript("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+""")
+
+
+def replay_paper(pipe, field, payload):
+    # dropped instead if the student has taken the course since it was parked
+    paper = unpack(PAPER, payload)
+    requeue_paper(pipe, payload, paper['user_id'], paper['course_id'])
+
+
+def replay_admin_request(pipe, field, payload):
+    pipe.hset(admin_request_key, field, payload)
+    record_enqueued(pipe, ADMIN_REQUESTS, field)
+
+
+class DeadLetterQueue(object):
+    """
+    A hash of failed items (field -> payload of `kind`) and a sorted set of when each is next due
+    for a retry. The number of replays is kept in the payload's meta as 'replay_attempts', so it
+    survives the item failing again and being parked under a new field. Items that cannot be
+    replayed at all, e.g. undecodable payloads, are listed in a set of exhausted fields instead.
+    """
+    def __init__(self, name, hash_key, kind, replay):
+        self.name = name
+        self.hash_key = hash_key
+        self.kind = kind
+        self.schedule_key = hash_key + ':schedule'
+        self.exhausted_key = hash_key + ':exhausted'
+        self.replay = replay
+
+    def schedule_new_items(self, data_cache):
+        """Gives every parked item that has no retry time yet one based on its attempts so far."""
+        scheduled, cursor, now = 0, 0, time.time()
+        while True:
+            cursor, items = data_cache.hscan(self.hash_key, cursor, count=replay_batch_size)
+            fields = list(items.keys())
+            pipe = data_cache.pipeline(transaction=False)
+            for field in fields:
+                pipe.zscore(self.schedule_key, field)
+                pipe.sismember(self.exhausted_key, field)
+            replies = pipe.execute() if len(fields) != 0 else []
+            new_schedule = {}
+            for field, retry_time, exhausted in zip(fields, replies[::2], replies[1::2]):
+                attempts = replay_attempts(self.kind, items[field])
+                # exhausted items wait for a human
+                if retry_time is None and not exhausted and attempts < max_attempts:
+                    new_schedule[field] = now + backoff(attempts)
+            if len(new_schedule) != 0:
+                data_cache.zadd(self.schedule_key, new_schedule)
+                scheduled += len(new_schedule)
+            if cursor == 0:
+                break
+        return scheduled
+
+    def due_fields(self, data_cache, limit):
+        return data_cache.zrangebyscore(self.schedule_key, '-inf', time.time(), start=0, num=limit)
+
+    def replay_fields(self, data_cache, fields, logger):
+        """
+        Moves the given items back onto their live queue in one pipeline. An item that cannot be
+        replayed is logged and marked exhausted, and stays parked.
+        """
+        if len(fields) == 0:
+            return 0
+        payloads = data_cache.hmget(self.hash_key, fields)
+        pipe = data_cache.pipeline()
+        replayed = 0
+        for field, payload in zip(fields, payloads):
+            pipe.zrem(self.schedule_key, field)
+            if payload is None:
+                continue
+            try:
+                self.replay(pipe, field, with_attempt(self.kind, payload))
+            except (ValueError, TypeError, KeyError, AttributeError) as exc:
+                logger.write('{}: Cannot replay {} {}: {}\n'.format(datetime.utcnow(), self.name, field, str(exc)))
+                pipe.sadd(self.exhausted_key, field)
+                continue
+            pipe.hdel(self.hash_key, field)
+            pipe.srem(self.exhausted_key, field)
+            replayed += 1
+        pipe.execute()
+        return replayed
+
+
+dead_letter_queues = dict((queue.name, queue) for queue in [
+    DeadLetterQueue('papers', 'tuq:error_unmarked_papers', PAPER, replay_paper),
+    DeadLetterQueue('admin_requests', 'tuq:admin_request_fails', ADMIN_REQUEST, replay_admin_request)])
+
+
+def backoff(attempts):
+    delay = min(max_delay, base_delay * (2 ** attempts))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def replay_attempts(kind, payload):
+    try:
+        return int(unpack_with_meta(kind, payload)[1].get('replay_attempts', 0))
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+def with_attempt(kind, payload):
+    """Re-packs the payload with one more replay attempt; legacy JSON payloads come out enveloped."""
+    try:
+        record, meta = unpack_with_meta(kind, payload)
+    except (ValueError, TypeError):
+        return payload
+    meta['replay_attempts'] = int(meta.get('replay_attempts', 0)) + 1
+    return pack(kind, record, meta)
+
+
+def run(logger):
+    bucket = TokenBucket(replay_rate)
+    last_scan = 0
+    while True:
+        if time.time() - last_scan >= scan_interval:
+            for queue in dead_letter_queues.values():
+                queue.schedule_new_items(data_cache)
+            last_scan = time.time()
+        for queue in dead_letter_queues.values():
+            allowed = bucket.take_up_to(replay_batch_size)
+            if allowed == 0:
+                break
+            fields = queue.due_fields(data_cache, allowed)
+            replayed = queue.replay_fields(data_cache, fields, logger)
+            bucket.give_back(allowed - replayed)
+            if replayed != 0:
+                logger.write('{}: Replayed {} {}\n'.format(datetime.utcnow(), replayed, queue.name))
+                logger.flush()
+        time.sleep(tick_interval)
+
+
+def list_items(queue):
+    now = time.time()
+    for field, payload in data_cache.hscan_iter(queue.hash_key, count=replay_batch_size):
+        due = data_cache.zscore(queue.schedule_key, field)
+        attempts = replay_attempts(queue.kind, payload)
+        if attempts >= max_attempts or data_cache.sismember(queue.exhausted_key, field):
+            state = 'exhausted'
+        elif due is None:
+            state = 'unscheduled'
+        else:
+            state = 'due in {:.0f}s'.format(max(0, due - now))
+        print('{}\t{}\tattempts={}\t{}'.format(queue.name, field.decode('utf-8'), attempts, state))
+
+
+def hash_plain_passwords(hash_key):
+    """
+    Rewrites the admin requests in `hash_key` that were queued before the web tier hashed
+    passwords, so no plain text password stays in Redis until the broker gets to it.
+    :return: the number of requests rewritten.
+    """
+    rewritten = 0
+    for field, payload in data_cache.hscan_iter(hash_key, count=replay_batch_size):
+        try:
+            record, meta = unpack_with_meta(ADMIN_REQUEST, payload)
+        except (ValueError, TypeError):
+            continue
+        if not record.get('password'):
+            continue
+        if not record.get('password_hash'):
+            record['password_hash'] = hash_password(record['password'])
+        record['password'] = None
+        rewritten += replace_payload(data_cache, [hash_key], [field, payload, pack(ADMIN_REQUEST, record, meta)])
+    return rewritten
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Inspects and replays dead-lettered queue items')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('run', help='replay due items with backoff until stopped')
+    list_parser = commands.add_parser('list', help='list parked items')
+    list_parser.add_argument('queue', nargs='?', choices=sorted(dead_letter_queues.keys()))
+    inspect_parser = commands.add_parser('inspect', help='print the payload of a parked item')
+    inspect_parser.add_argument('queue', choices=sorted(dead_letter_queues.keys()))
+    inspect_parser.add_argument('field')
+    replay_parser = commands.add_parser('replay', help='replay items now, ignoring backoff and attempts')
+    replay_parser.add_argument('queue', choices=sorted(dead_letter_queues.keys()))
+    replay_parser.add_argument('fields', nargs='*')
+    replay_parser.add_argument('--all', action='store_true', help='replay every parked item of the queue')
+    commands.add_parser('hash-passwords', help='hash the plain text passwords of queued and parked admin requests')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.command == 'run':
+        run(open('./logs.txt', 'a'))
+    elif arguments.command == 'list':
+        for name in [arguments.queue] if arguments.queue else sorted(dead_letter_queues.keys()):
+            list_items(dead_letter_queues[name])
+    elif arguments.command == 'inspect':
+        queue = dead_letter_queues[arguments.queue]
+        payload = data_cache.hget(queue.hash_key, arguments.field)
+        if payload is None:
+            print('No such item')
+        else:
+            try:
+                record, meta = unpack_with_meta(queue.kind, payload)
+                print(json.dumps({'record': record, 'meta': meta}, indent=2, sort_keys=True))
+            except ValueError as exc:
+                print('Undecodable payload ({}): {!r}'.format(exc, payload))
+    elif arguments.command == 'replay':
+        queue = dead_letter_queues[arguments.queue]
+        fields = list(data_cache.hkeys(queue.hash_key)) if arguments.all else arguments.fields
+        for start in range(0, len(fields), replay_batch_size):
+            replayed = queue.replay_fields(data_cache, fields[start:start + replay_batch_size], sys.stdout)
+            print('Replayed {} items'.format(replayed))
+    elif arguments.command == 'hash-passwords':
+        for hash_key in (admin_request_key, dead_letter_queues['admin_requests'].hash_key):
+            print('{}: hashed the passwords of {} requests'.format(hash_key, hash_plain_passwords(hash_key)))
@@ -9,28 +9,43 @@ from flask import Flask, render_template
 from itsdangerous import TimedJSONWebSignatureSerializer as TJsonSerializer
 from flask_mail import Message, Mail
 from sqlalchemy.exc import InvalidRequestError, ProgrammingError, IntegrityError
-from threading import Thread
-import os, redis, time, json
+from queue_metrics import take_enqueue_times, record_processed, CONFIRMATION_EMAILS
+from email_dispatch import EmailDispatcher, MailJob
+from payloads import unpack, CONFIRMATION
+from email_queue import take_confirmations, finish_confirmations, requeue_unfinished, drain_legacy_hash
+import os, redis, smtplib, socket, time
 
 
 cache_pass,port_number=os.environ.get('redis_pass'),int(os.environ.get('redis_port'))
 data_cache = redis.StrictRedis(password=cache_pass,port=port_number)
-sleep_time = 60 * 10# every 10 minutes
+batch_size = int(os.environ.get('EMAIL_BROKER_BATCH_SIZE', 100))
 
 failed_confirmation_emails = 'tuq:failed_confirmation_emails'
-pending_confirmation_emails = 'tuq:pending_confirmation_emails'
 FROM_MAIL='[Tuq]The Universal Quiz Network'
 COMPANY_NAME = 'Tuq'
 EXPIRY_INTERVAL = 60 * 60 * 12 #12hours
+# opening a connection (connect, EHLO, STARTTLS) is tried this many times in all
+connect_attempts = 3
+# a connection idle for longer than this is checked with NOOP before it is used again
+idle_check_after = 10
+# errors raised before the server could have received any mail, so the send is safe to retry
+connect_errors = (smtplib.SMTPConnectError, smtplib.SMTPHeloError, smtplib.SMTPServerDisconnected, socket.error)
+# SMTP connections sending at once, the provider's sending quota in mails per second and the
+# most mails in flight to any one recipient domain
+email_workers = int(os.environ.get('EMAIL_WORKERS', 4))
+email_rate = float(os.environ.get('EMAIL_RATE', 5))
+email_domain_concurrency = int(os.environ.get('EMAIL_DOMAIN_CONCURRENCY', 2))
 
 
 def create_app():
     app = Flask( __name__ )
 
     app.config['SECRET_KEY'] = os.environ.get( 'SECRET_KEY' )
-    app.config['MAIL_SERVER'] = 'smtp.googlemail.com'
-    app.config['MAIL_PORT'] = 587
-    app.config['MAIL_USE_TLS'] = True
+    app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.googlemail.com')
+    app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+    app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', 'true').lower() in ('1', 'true', 'yes')
+    # Flask-Mail quits and reopens the connection after this many messages
+    app.config['MAIL_MAX_EMAILS'] = int(os.environ.get('MAIL_MAX_EMAILS', 100))
     app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
     app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
     return app
@@ -41,19 +56,75 @@ def generate_confirmation_token(email, user_id, expiry):
     return s.dumps({'endUsers': str(email), 'id': user_id })
 
 
-def send_mail(to_mail,subject, message_body):
+class MailSession(object):
+    """
+    One SMTP connection shared by every mail of a batch. It is opened on the first send, and
+    reopened when the server has dropped it while idle. A mail is never sent twice: a send that
+    fails once the connection is up may already have been delivered, so its error is raised.
+    """
+    def __init__(self, mail):
+        self.mail = mail
+        self.connection = None
+        self.last_used = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        for attempt in range(connect_attempts):
+            try:
+                connection = self.mail.connect()
+                connection.__enter__()
+                self.connection = connection
+                return
+            except connect_errors:
+                if attempt + 1 == connect_attempts:
+                    raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.connection = None
+
+    def ensure_open(self):
+        if self.connection is not None and time.time() - self.last_used > idle_check_after:
+            try:
+                self.connection.host.noop()
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self.close()
+        if self.connection is None:
+            self.open()
+
+    def send(self, message):
+        self.ensure_open()
+        try:
+            self.connection.send(message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.close()
+            raise
+        finally:
+            self.last_used = time.time()
+
+
+def make_mail(to_mail,subject, message_body):
     message = Message(subject, sender=FROM_MAIL, recipients=[to_mail])
     message.body = message_body
-    mail.send(message)
+    return message
 
 
-def send_confirmation_message(user_email, user_id, fullname, expiry):
+def confirmation_message(user_email, user_id, fullname, expiry):
     token = generate_confirmation_token(user_email, user_id, expiry)
     link_url = 'https://sproot.xyz/tuq/confirm?token={}'.format(token)
     
     body = render_template('end_user_confirm.txt', full_name=fullname, 
         company=COMPANY_NAME, link_url=link_url)
-    send_mail(user_email, subject='[Tuq] Confirm your email account',message_body=body)
+    return make_mail(user_email, subject='[Tuq] Confirm your email account',message_body=body)
 
 
 
@@ -63,26 +134,40 @@ mail.init_app(app)
 
 
 def main():
-    time.sleep( 5 )
+    dispatcher = EmailDispatcher(app, lambda: MailSession(mail), email_workers, email_rate,
+                                 email_domain_concurrency).start()
+    print('Requeued {} unfinished and {} legacy confirmations'.format(
+        requeue_unfinished(data_cache), drain_legacy_hash(data_cache)))
     with app.app_context():
-        while(True):
-            mail_receivers = data_cache.hkeys(pending_confirmation_emails)
-            if len(mail_receivers) == 0:
-                time.sleep(sleep_time)
-            for mail_receiver in mail_receivers:
-                receiver_info = data_cache.hget(pending_confirmation_emails,mail_receiver)
-                receiver_id, fullname = (receiver_info[0], receiver_info[1])
+        while True:
+            payloads = take_confirmations(data_cache, batch_size)
+            pipe = data_cache.pipeline(transaction=False)
+            jobs, failed = [], []
+            for payload in payloads:
                 try:
-                    send_confirmation_message(mail_receiver, receiver_id, fullname, EXPIRY_INTERVAL)
+                    confirmation = unpack(CONFIRMATION, payload)
+                    job = MailJob(confirmation['user_id'], confirmation['email'], None)
+                except ValueError as e:
+                    print('Dropping malformed confirmation {!r}: {}'.format(payload, e))
+                    continue
+                try:
+                    job.message = confirmation_message(job.recipient, job.key, confirmation.get('fullname'),
+                                                       EXPIRY_INTERVAL)
+                    jobs.append(job)
                 except Exception as e:
-                    print e
-                    data_cache.hset(failed_confirmation_emails,mail_receiver, receiver_id)
-                data_cache.hdel(pending_confirmation_emails, mail_receiver)
+                    job.error = e
+                    failed.append(job)
+            enqueue_times = take_enqueue_times(data_cache, CONFIRMATION_EMAILS,
+                                               [job.recipient for job in jobs + failed])
+            failed += [job for job in dispatcher.dispatch(jobs) if job.error is not None]
+            for job in failed:
+                print(job.error)
+                pipe.hset(failed_confirmation_emails, job.recipient, job.key)
+            finish_confirmations(pipe, payloads)
+            record_processed(pipe, CONFIRMATION_EMAILS, enqueue_times, len(failed))
+            pipe.execute()
+            print('Email dispatch: {}'.format(dispatcher.stats()))
 
 
 if __name__ == '__main__':
-    new_thread = Thread(target=main, args=[])
-    new_thread.setName('ConfirmationEmailSenderDaemon')
-    new_thread.setDaemon(True)
-    new_thread.start()
-    app.run(port=8766)
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  email_dispatch.py
+#
+#  Copyright 2017 Josh <ogunyinkajoshua@gmail.com>
+
+from rate_limiter import TokenBucket
+from queue_metrics import latency_bucket
+from threading import Thread, Lock, BoundedSemaphore
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+
+# a worker closes its SMTP connection after this many seconds without work
+idle_timeout = 30
+
+
+class MailJob(object):
+    def __init__(self, key, recipient, message):
+        self.key = key
+        self.recipient = recipient
+        self.message = message
+        self.error = None
+
+
+class DomainLimiter(object):
+    """Caps how many mails are in flight to any one recipient domain at a time."""
+    def __init__(self, per_domain):
+        self.per_domain = per_domain
+        self.semaphores = {}
+        self.lock = Lock()
+
+    def semaphore(self, recipient):
+        domain = recipient.rsplit('@', 1)[-1].lower()
+        with self.lock:
+            if domain not in self.semaphores:
+                self.semaphores[domain] = BoundedSemaphore(self.per_domain)
+            return self.semaphores[domain]
+
+
+class EmailDispatcher(object):
+    """
+    Sends mails from a bounded pool of worker threads, each holding its own SMTP session, while
+    keeping the pool as a whole under `rate` mails per second.
+    :param app: the Flask app whose context the workers send in.
+    :param session_factory: returns a new MailSession-like object with send() and close().
+    """
+    def __init__(self, app, session_factory, workers, rate, per_domain):
+        self.app = app
+        self.session_factory = session_factory
+        self.workers = workers
+        self.jobs = Queue(maxsize=workers * 2)
+        self.bucket = TokenBucket(rate)
+        self.domains = DomainLimiter(per_domain)
+        self.lock = Lock()
+        self.counters = {'sent': 0, 'failed': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self.latency = {}
+        self.threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = Thread(target=self.run_worker)
+            thread.setName('EmailDispatcher-{}'.format(index))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def run_worker(self):
+        with self.app.app_context():
+            session = self.session_factory()
+            while True:
+                try:
+                    job = self.jobs.get(timeout=idle_timeout)
+                except Empty:
+                    session.close()
+                    continue
+                try:
+                    self.send(session, job)
+                finally:
+                    self.jobs.task_done()
+
+    def send(self, session, job):
+        with self.domains.semaphore(job.recipient):
+            self.bucket.acquire()
+            started = time.time()
+            try:
+                session.send(job.message)
+            except Exception as exc:
+                job.error = exc
+            self.record(job, time.time() - started)
+
+    def record(self, job, seconds):
+        with self.lock:
+            self.counters['failed' if job.error is not None else 'sent'] += 1
+            self.counters['latency_total'] += seconds
+            self.counters['latency_max'] = max(self.counters['latency_max'], seconds)
+            bucket = latency_bucket(seconds)
+            self.latency[bucket] = self.latency.get(bucket, 0) + 1
+
+    def dispatch(self, jobs):
+        """Sends every job and waits for all of them; failures are left in each job's `error`."""
+        for job in jobs:
+            self.jobs.put(job)
+        self.jobs.join()
+        return jobs
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['latency'] = dict(self.latency)
+        attempted = stats['sent'] + stats['failed']
+        stats['latency_mean'] = stats.pop('latency_total') / attempted if attempted else 0.0
+        return stats
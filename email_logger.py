@@ -1,13 +1,14 @@
 #!/usr/bin/env python
 
-import pika, os
+from datetime import datetime
+import pika, os, gzip, shutil
 
 
 def initialize_channel():
     (username, password) = (os.environ.get('RABBIT_USERNAME'), os.environ.get('RABBIT_PASSWORD'))
     vhost_name = os.environ.get('RABBIT_VHOST')
     credentials = pika.PlainCredentials(username, password)
-    conn_parameters = pika.ConnectionParameters('localhost', virtual_host=vhost_name, 
+    conn_parameters = pika.ConnectionParameters('localhost', virtual_host=vhost_name,
         credentials=credentials)
     conn_broker = pika.BlockingConnection(conn_parameters)
     return conn_broker.channel()
@@ -16,17 +17,96 @@ def initialize_channel():
 LOG_RECEIVER_QUEUE = ( 'email_log_queue' )
 EXCHANGE_NAME = 'email_exchange'
 FILENAME = 'email_log_file.txt'
-my_file = None
+# unacknowledged messages RabbitMQ may push to us at once; a batch is written and acked at the
+# latest when this many are pending, FLUSH_BYTES are buffered or FLUSH_INTERVAL seconds pass
+PREFETCH_COUNT = int(os.environ.get('EMAIL_LOG_PREFETCH', 1000))
+FLUSH_BYTES = int(os.environ.get('EMAIL_LOG_FLUSH_BYTES', 64 * 1024))
+FLUSH_INTERVAL = float(os.environ.get('EMAIL_LOG_FLUSH_INTERVAL', 1))
+# the log is compressed and a new one started once it grows past this size
+MAX_LOG_BYTES = int(os.environ.get('EMAIL_LOG_MAX_BYTES', 50 * 1024 * 1024))
 
 
-def email_log_receiver_callback( channel, method, header, message ):
-    channel.basic_ack( delivery_tag = method.delivery_tag )
-    if message == 'quit':
-        channel.basic_cancel(consumer_tag='logs')
-        channel.stop_consuming()
-        my_file.close()
-    else:
-        my_file.write( message )
+class LogSink(object):
+    """Buffers log lines in memory and writes them out with one write and fsync per flush."""
+    def __init__(self, filename, max_bytes=MAX_LOG_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.buffered = 0
+        self.file = open(filename, 'ab')
+
+    def write(self, message):
+        self.buffer.append(message)
+        self.buffered += len(message)
+
+    def flush(self):
+        if len(self.buffer) != 0:
+            self.file.write(b''.join(self.buffer))
+            self.buffer, self.buffered = [], 0
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        rotated = '{}.{}'.format(self.filename, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        os.rename(self.filename, rotated)
+        self.file = open(self.filename, 'ab')
+        with open(rotated, 'rb') as source:
+            with gzip.open(rotated + '.gz', 'wb') as compressed:
+                shutil.copyfileobj(source, compressed)
+        os.remove(rotated)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class BatchingLogConsumer(object):
+    """
+    Hands every message to the sink and acknowledges them with one multiple=True ack, only after
+    the sink has fsynced them; a crash in between redelivers the batch rather than losing it.
+    """
+    def __init__(self, channel, sink, prefetch_count=PREFETCH_COUNT, flush_bytes=FLUSH_BYTES,
+                 flush_interval=FLUSH_INTERVAL):
+        self.channel = channel
+        self.sink = sink
+        self.prefetch_count = prefetch_count
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.last_delivery_tag = None
+        self.pending = 0
+
+    def commit(self):
+        if self.last_delivery_tag is None:
+            return
+        self.sink.flush()
+        self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
+        self.last_delivery_tag, self.pending = None, 0
+
+    def on_timer(self):
+        self.commit()
+        self.channel.connection.add_timeout(self.flush_interval, self.on_timer)
+
+    def email_log_receiver_callback(self, channel, method, header, message):
+        self.last_delivery_tag = method.delivery_tag
+        if message == b'quit':
+            self.commit()
+            channel.basic_cancel(consumer_tag='logs')
+            channel.stop_consuming()
+            return
+        self.sink.write(message)
+        self.pending += 1
+        if self.pending >= self.prefetch_count or self.sink.buffered >= self.flush_bytes:
+            self.commit()
+
+    def start(self):
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        self.channel.basic_consume(self.email_log_receiver_callback, consumer_tag='logs',
+            queue=LOG_RECEIVER_QUEUE)
+        self.channel.connection.add_timeout(self.flush_interval, self.on_timer)
+        self.channel.start_consuming()
 
 
 def initialize_email_receiver(channel):
@@ -34,13 +114,13 @@ def initialize_email_receiver(channel):
         exchange_type='topic')
     channel.queue_declare(queue=LOG_RECEIVER_QUEUE)
     channel.queue_bind(queue=LOG_RECEIVER_QUEUE, exchange=EXCHANGE_NAME, routing_key='*.log')
-    channel.basic_consume(email_log_receiver_callback, consumer_tag='logs', 
-        queue=LOG_RECEIVER_QUEUE)
 
 
 if __name__ == '__main__':
     channel = initialize_channel()
     initialize_email_receiver(channel)
-    global my_file
-    my_file = open(FILENAME, 'a')
-    channel.start_consuming()
+    sink = LogSink(FILENAME)
+    try:
+        BatchingLogConsumer(channel, sink).start()
+    finally:
+        sink.close()
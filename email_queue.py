@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  email_queue.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from queue_metrics import record_enqueued, CONFIRMATION_EMAILS
+from payloads import pack, CONFIRMATION
+
+
+# producers LPUSH, the email broker blocks on BRPOPLPUSH so an idle broker costs nothing and
+# mails in flight survive a crash in the processing list
+confirmation_queue = 'tuq:confirmation_email_queue'
+confirmation_processing = 'tuq:confirmation_email_queue:processing'
+# hash of email -> '<user_id> %% <fullname>' polled by the previous broker
+legacy_pending_emails = 'tuq:pending_confirmation_emails'
+drain_batch_size = 100
+
+
+def confirmation_payload(email, user_id, fullname):
+    return pack(CONFIRMATION, {'email': email, 'user_id': user_id, 'fullname': fullname})
+
+
+def enqueue_confirmation(pipe, email, user_id, fullname):
+    pipe.lpush(confirmation_queue, confirmation_payload(email, user_id, fullname))
+    record_enqueued(pipe, CONFIRMATION_EMAILS, email)
+
+
+def take_confirmations(data_cache, count, timeout=0):
+    """
+    Blocks until at least one confirmation is queued, then takes up to `count` of them in one
+    round trip. Taken payloads stay in the processing list until finish_confirmations is called.
+    """
+    first = data_cache.brpoplpush(confirmation_queue, confirmation_processing, timeout=timeout)
+    if first is None:
+        return []
+    pipe = data_cache.pipeline(transaction=False)
+    for _ in range(count - 1):
+        pipe.rpoplpush(confirmation_queue, confirmation_processing)
+    return [first] + [payload for payload in pipe.execute() if payload is not None]
+
+
+def finish_confirmations(pipe, payloads):
+    for payload in payloads:
+        pipe.lrem(confirmation_processing, 1, payload)
+
+
+def requeue_unfinished(data_cache):
+    """Puts back the confirmations a crashed broker had taken, oldest first in line."""
+    unfinished = data_cache.lrange(confirmation_processing, 0, -1)
+    if len(unfinished) != 0:
+        pipe = data_cache.pipeline()
+        pipe.rpush(confirmation_queue, *unfinished)
+        pipe.delete(confirmation_processing)
+        pipe.execute()
+    return len(unfinished)
+
+
+def drain_legacy_hash(data_cache):
+    """Moves confirmations queued by older web workers in the polled hash onto the list."""
+    cursor, drained = 0, 0
+    while True:
+        cursor, pending = data_cache.hscan(legacy_pending_emails, cursor, count=drain_batch_size)
+        pipe = data_cache.pipeline()
+        for email, receiver_info in pending.items():
+            user_id, _, fullname = receiver_info.decode('utf-8').partition(' %% ')
+            enqueue_confirmation(pipe, email.decode('utf-8'), user_id, fullname)
+            pipe.hdel(legacy_pending_emails, email)
+        pipe.execute()
+        drained += len(pending)
+        if cursor == 0:
+            return drained
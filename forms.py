@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, ValidationError
+from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email, Length, Regexp, EqualTo, Optional, InputRequired
 from resources import data_cache
+from reservations import reserve_identity, admin_reservation_ttl, RESERVED, USERNAME_TAKEN, EMAIL_TAKEN
 
 
 class AdminRequestForm(FlaskForm):
@@ -22,14 +23,23 @@ class AdminRequestForm(FlaskForm):
     password2 = PasswordField('Repeat password', validators=[DataRequired()])
     submit = SubmitField('Submit')
 
-    def validate_email(self, field):
-        if data_cache.sismember('tuq:emails', field.data):
-            raise ValidationError('Email address has already been registered')
-    
-    def validate_username(self, field):
-        if data_cache.sismember('tuq:usernames', field.data):
-            raise ValidationError('Username already registered')
+    reservation = None
 
-    def validate_phone_number(self, field):
-        if data_cache.sismember('tuq:phones', field.data):
-            raise ValidationError('Mobile number already registered')
+    def validate(self):
+        """
+        Checks and holds the username, email and phone number in one atomic step once the fields
+        are otherwise valid; the reservation token is kept in `reservation` for the admin broker.
+        """
+        if not FlaskForm.validate(self):
+            return False
+        status, reservation = reserve_identity(data_cache, self.username.data, self.email.data,
+                                               self.phone_number.data, ttl=admin_reservation_ttl)
+        if status == USERNAME_TAKEN:
+            self.username.errors.append('Username already registered')
+        elif status == EMAIL_TAKEN:
+            self.email.errors.append('Email address has already been registered')
+        elif status != RESERVED:
+            self.phone_number.errors.append('Mobile number already registered')
+        else:
+            self.reservation = reservation
+        return status == RESERVED
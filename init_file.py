@@ -10,6 +10,7 @@ from models import db
 from flask_uploads import configure_uploads, patch_request_class
 from flask_bootstrap import Bootstrap
 from flask_wtf.csrf import CSRFProtect
+import json_codec
 import os
 
 moment = Moment()
@@ -26,6 +27,7 @@ def create_app():
     # app.config['UPLOADS_DEFAULT_DEST'] = os.environ.get('UPLOAD_DIR')
     app.config['UPLOADS_DEFAULT_URL'] = os.environ.get('GENERAL_UPLOAD_URL')
 
+    json_codec.init_app(app)
     moment.init_app(app)
     db.init_app(app)
     bootstrap.init_app(app)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  item_analysis.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from models import ExamTaken
+from datetime import datetime
+import argparse
+import numpy
+import json_codec
+
+
+item_analysis_format = 'tuq:item_analysis:{course_id}'
+chunk_size = 2000
+# share of the best and worst papers compared by the discrimination index
+group_fraction = 0.27
+max_option_index = numpy.iinfo(numpy.int32).max
+
+
+def invalidate_item_analysis(data_cache, course_id):
+    data_cache.delete(item_analysis_format.format(course_id=course_id))
+
+
+def load_answer_matrix(database_handle, course_id, arity):
+    """
+    Streams the stored answers of a course with a server-side cursor, decoding them a chunk at a
+    time into one (papers x questions) matrix. Papers answered against a key of another length
+    are skipped.
+    """
+    rows = database_handle.session.query(ExamTaken.other_data).filter(ExamTaken.course_id == course_id)\
+        .execution_options(stream_results=True).yield_per(chunk_size)
+    chunks, chunk = [], []
+    for (other_data,) in rows:
+        try:
+            answers = [int(answer) for answer in json_codec.loads(other_data)]
+        except (ValueError, TypeError):
+            continue
+        # values int32 cannot hold are no option anyway; analyse counts them as unanswered
+        answers = [answer if -1 <= answer <= max_option_index else -1 for answer in answers]
+        if len(answers) != arity:
+            continue
+        chunk.append(answers)
+        if len(chunk) == chunk_size:
+            chunks.append(numpy.array(chunk, dtype=numpy.int32))
+            chunk = []
+    if len(chunk) != 0:
+        chunks.append(numpy.array(chunk, dtype=numpy.int32))
+    if len(chunks) == 0:
+        return numpy.zeros((0, arity), dtype=numpy.int32)
+    return numpy.vstack(chunks)
+
+
+def option_counts(quiz_filename, solution):
+    """
+    :return: the number of options of each question, from the quiz definition. A question the
+    definition does not describe gets as many as its correct option needs.
+    """
+    counts = solution + 1
+    try:
+        with open(quiz_filename, 'r') as quiz_file:
+            items = json_codec.load(quiz_file)['items']
+    except (IOError, OSError, ValueError, TypeError, KeyError) as exc:
+        print('Unable to read the options of {}: {}'.format(quiz_filename, str(exc)))
+        return counts
+    for index, item in enumerate(items[:len(counts)]):
+        try:
+            options = item['options']
+            counts[index] = max(counts[index], int(options.get('arity', len(options['items']))))
+        except (ValueError, TypeError, KeyError, AttributeError):
+            continue
+    return counts
+
+
+def analyse(solution, answer_matrix, options_per_question):
+    """
+    :param solution: answer key of the course, one option index per question.
+    :param answer_matrix: one row of option indices per paper; negative entries, and those past the
+    question's last option, are unanswered.
+    :param options_per_question: the number of options of each question, from option_counts.
+    :return: per-question difficulty (share answering correctly), discrimination index (difficulty
+    among the top 27% of papers minus among the bottom 27%) and option-choice counts.
+    """
+    paper_count, question_count = answer_matrix.shape
+    if paper_count == 0:
+        return {'submissions': 0, 'questions': []}
+    correct = answer_matrix == solution
+    difficulty = correct.mean(axis=0)
+
+    group_size = max(1, int(round(paper_count * group_fraction)))
+    ranked = numpy.argsort(correct.sum(axis=1), kind='mergesort')
+    discrimination = correct[ranked[-group_size:]].mean(axis=0) - correct[ranked[:group_size]].mean(axis=0)
+
+    # sized by the quiz, not by the answers, so a forged option index cannot inflate the table
+    answered = (answer_matrix >= 0) & (answer_matrix < options_per_question)
+    option_count = int(options_per_question.max())
+    offsets = numpy.arange(question_count) * option_count
+    flat = (answer_matrix + offsets)[answered]
+    options = numpy.bincount(flat, minlength=question_count * option_count).reshape(question_count, option_count)
+    unanswered = paper_count - answered.sum(axis=0)
+
+    questions = []
+    for index in range(question_count):
+        questions.append({'index': index, 'difficulty': float(difficulty[index]),
+                          'discrimination': float(discrimination[index]),
+                          'options': [int(count) for count in options[index][:options_per_question[index]]],
+                          'unanswered': int(unanswered[index])})
+    return {'submissions': paper_count, 'questions': questions}
+
+
+def get_item_analysis(data_cache, database_handle, answer_key):
+    """Serves the cached analysis of a course, computing it when a new paper has been marked since."""
+    cache_key = item_analysis_format.format(course_id=answer_key.id)
+    cached = data_cache.get(cache_key)
+    if cached is not None:
+        return json_codec.loads(cached)
+    result = analyse(answer_key.solution, load_answer_matrix(database_handle, answer_key.id, len(answer_key)),
+                     option_counts(answer_key.quiz_filename, answer_key.solution))
+    result['computed_on'] = str(datetime.utcnow())
+    data_cache.set(cache_key, json_codec.dumps(result))
+    return result
+
+
+if __name__ == '__main__':
+    from init_file import create_app
+    from resources import data_cache
+    from answer_keys import AnswerKeyCache
+    from models import db
+
+    parser = argparse.ArgumentParser(description='Computes and caches the item analysis of courses')
+    parser.add_argument('course_ids', type=int, nargs='+')
+    arguments = parser.parse_args()
+    with create_app().app_context():
+        answer_keys = AnswerKeyCache(db, data_cache)
+        answer_keys.refresh_versions()
+        for course_id in arguments.course_ids:
+            invalidate_item_analysis(data_cache, course_id)
+            result = get_item_analysis(data_cache, db, answer_keys.get(course_id))
+            print('{}: Course {} analysed over {} papers'.format(datetime.utcnow(), course_id, result['submissions']))
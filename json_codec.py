@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  json_codec.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from flask.json import JSONEncoder
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson is used whenever it is installed, the standard library otherwise; both write compact
+# separators and encode what Flask's own JSONEncoder does (dates as HTTP dates, UUIDs, Markup)
+encoder = JSONEncoder()
+separators = (',', ':')
+backend = 'orjson' if orjson is not None else 'json'
+
+
+def dumps(obj, sort_keys=False):
+    """:return: the JSON text of `obj` as unicode."""
+    if orjson is not None:
+        option = orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(obj, default=encoder.default, option=option).decode('utf-8')
+        except TypeError:
+            pass  # e.g. non-string keys, which the standard library converts
+    return json.dumps(obj, default=encoder.default, separators=separators, sort_keys=sort_keys)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def dump(obj, fp, sort_keys=False):
+    fp.write(dumps(obj, sort_keys=sort_keys))
+
+
+def load(fp):
+    return loads(fp.read())
+
+
+class CodecJSONEncoder(JSONEncoder):
+    """
+    Flask's JSONEncoder with encode() routed through dumps, so flask.jsonify and flask.json.dumps
+    use orjson too; output Flask asks to be indented keeps the standard library's layout.
+    """
+    def encode(self, o):
+        if self.indent is not None:
+            return JSONEncoder.encode(self, o)
+        return dumps(o, sort_keys=self.sort_keys)
+
+
+def init_app(app):
+    app.json_encoder = CodecJSONEncoder
+    # jsonify would otherwise indent and sort every response that is not an XMLHttpRequest
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    app.config['JSON_SORT_KEYS'] = False
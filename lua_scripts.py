@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  lua_scripts.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from redis.client import Script
+
+
+class LuaScript(object):
+    """
+    A Lua script run with EVALSHA rather than sending its source with every EVAL. redis-py loads
+    it on the first NOSCRIPT, or before executing a pipeline that uses it. The Script is made on
+    the first call because it needs a client to encode the source.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.script = None
+
+    def __call__(self, client, keys, args):
+        if self.script is None:
+            self.script = Script(client, self.source)
+        return self.script(keys=keys, args=args, client=client)
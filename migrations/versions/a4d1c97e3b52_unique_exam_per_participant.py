@@ -0,0 +1,29 @@
+"""One exams_taken row per course and participant
+
+Revision ID: a4d1c97e3b52
+Revises: b32676be6cdb
+Create Date: 2026-10-18 12:00:00.000000
+
+Duplicate rows left by redelivered papers are deleted first, keeping the earliest. Rebuild
+course_stats and all_course_rank with rebuild_cache.py afterwards, as they counted the duplicates.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d1c97e3b52'
+down_revision = 'b32676be6cdb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('DELETE duplicate FROM exams_taken duplicate JOIN exams_taken kept '
+               'ON duplicate.course_id = kept.course_id AND duplicate.participant_id = kept.participant_id '
+               'AND duplicate.id > kept.id')
+    op.create_unique_constraint('uq_exams_taken_course_participant', 'exams_taken', ['course_id', 'participant_id'])
+
+
+def downgrade():
+    op.drop_constraint('uq_exams_taken_course_participant', 'exams_taken', type_='unique')
@@ -5,7 +5,7 @@
 
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin, AnonymousUserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from password_hasher import hash_password
 from flask_login import LoginManager
 from itsdangerous import TimedJSONWebSignatureSerializer as TJsonSerializer, SignatureExpired, BadSignature
 from random import randint
@@ -49,15 +49,12 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, data):
-        self.password_hash = generate_password_hash(data)
+        self.password_hash = hash_password(data)
         
     @property
     def confirmed(self):
         return self.is_confirmed
     
-    def verify_password(self, passwd):
-        return check_password_hash(self.password_hash, passwd)
-
     def __repr__(self):
         return '<User %r>' % self.username
     
@@ -173,6 +170,8 @@ class Department(db.Model):
 
 class ExamTaken(db.Model):
     __tablename__ = 'exams_taken'
+    # papers are delivered to the marker at least once; a redelivered one must not be stored twice
+    __table_args__ = (db.UniqueConstraint('course_id', 'participant_id', name='uq_exams_taken_course_participant'),)
     id = db.Column(db.Integer, primary_key=True, index = True)
     course_owner = db.Column(db.Integer, index=False, nullable=False, unique=False)
     course_id = db.Column(db.Integer, nullable=False)
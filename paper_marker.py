@@ -7,22 +7,37 @@
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from models import ExamTaken, Course
-from threading import Thread
+from models import ExamTaken
+from sqlalchemy import tuple_
+from answer_keys import AnswerKeyCache, answers_to_row, mark_papers
+from paper_queue import ensure_marker_group, move_legacy_papers, read_papers, reclaim_papers, acknowledge_papers
+from paper_queue import remove_dead_consumers, reclaim_interval
+from course_stats import record_scores
+from taken_index import release_taken
+from item_analysis import invalidate_item_analysis
+from queue_metrics import record_processed, paper_enqueue_time, PAPERS
+from payloads import unpack, PAPER
+from paper_queue import consumer_name, shards_for_worker, stream_shards
+from multiprocessing import Process, cpu_count
 from datetime import datetime
+import argparse
 import os
+import numpy
 import redis
 import time
-import json
+import json_codec
+import signal
 
 
 cache_pass, port_number = os.environ.get('redis_pass'), int(os.environ.get('redis_port'))
 data_cache = redis.StrictRedis(password=cache_pass, port=port_number)
-# sleep_time = 60 * 60 * 2 # 2 hours
-sleep_time = 60
-pending_paper_key = 'tuq:pending_papers'
+# how long a blocking read waits before the marker checks for abandoned entries
+block_time_ms = int(os.environ.get('MARKER_BLOCK_MS', 5000))
 error_marking_key = 'tuq:error_unmarked_papers'
 courses_taken = 'tuq:all_course_rank'
+# marked papers are written to MySQL once this many are waiting or the oldest has waited this long
+batch_size = int(os.environ.get('MARKER_BATCH_SIZE', 500))
+flush_interval = float(os.environ.get('MARKER_FLUSH_INTERVAL', 2))
 
 def create_app():
     application = Flask(__name__)
@@ -33,77 +48,316 @@ def create_app():
     return application
 
 
-def grab_course_data(course_id, database_handle):
-    course = database_handle.session.query(Course).filter_by(id=course_id).first()
-    if course is None:
-        raise ValueError('Course data is \'None\' for ID: {}'.format(course_id))
-    return course
+def decode_paper(user_paper, user_data_string):
+    user_data_object = unpack(PAPER, user_data_string)
+    return {'key': user_paper, 'raw': user_data_string, 'other_data': json_codec.dumps(user_data_object['answers']),
+            'answers': user_data_object['answers'],
+            'course_id': int(user_data_object.get('course_id')),
+            'user_id': int(user_data_object.get('user_id')),
+            'owner_id': int(user_data_object.get('owner_id')),
+            'date_taken': user_data_object.get('date_taken')}
 
 
-def mark_paper(course_data, user_solution_array):
+def group_papers_by_course(entries, failures, logger):
+    papers_by_course = {}
+    for user_paper, user_data_string in entries:
+        try:
+            paper = decode_paper(user_paper, user_data_string)
+        except (ValueError, TypeError, KeyError) as exc:
+            logger.write('{}: Error({}): {}\n'.format(datetime.utcnow(), user_paper, str(exc)))
+            failures.append((user_paper, user_data_string))
+            continue
+        papers_by_course.setdefault(paper['course_id'], []).append(paper)
+    return papers_by_course
+
+
+def mark_course_papers(course_id, papers, failures, logger):
+    """
+    Scores every paper submitted for one course with a single comparison against its answer key.
+    Papers that cannot be marked are moved to `failures`, the rest are returned with their scores.
+    """
+    try:
+        course_data = answer_keys.get(course_id)
+    except Exception as exc:
+        logger.write('{}: Error(course {}): {}\n'.format(datetime.utcnow(), course_id, str(exc)))
+        failures.extend((paper['key'], paper['raw']) for paper in papers)
+        return []
+    rows, valid_papers = [], []
+    for paper in papers:
+        try:
+            rows.append(answers_to_row(course_data, paper['answers']))
+            valid_papers.append(paper)
+        except (ValueError, TypeError, OverflowError) as exc:
+            logger.write('{}: Error({}): {}\n'.format(datetime.utcnow(), paper['key'], str(exc)))
+            failures.append((paper['key'], paper['raw']))
+    if len(valid_papers) == 0:
+        return []
+    scores, total = mark_papers(course_data, numpy.array(rows, dtype=numpy.int32))
+    for paper, score in zip(valid_papers, scores):
+        paper['score'], paper['total'] = int(score), total
+    return valid_papers
+
+
+def exam_taken_row(paper):
+    return {'course_id': paper['course_id'], 'participant_id': paper['user_id'],
+            'date_taken': paper['date_taken'], 'other_data': paper['other_data'], 'score': paper['score'],
+            'course_owner': paper['owner_id'], 'total_score': paper['total']}
+
+
+def taker_of(paper):
+    return paper['course_id'], paper['user_id']
+
+
+class ExamTakenBatch(object):
     """
-    :param user_solution_array: should be an array of index integers with length
-    EXACTLY == solutions data length.
-    :param course_data: should be the database query result holding information on
-    the course to be marked, including its unique ID.
+    Accumulates marked papers and writes them with one multi-row INSERT. If the batch is rejected,
+    it is retried row by row so only the offending papers are reported as failed. Papers are
+    delivered at least once, so those whose student already has a row in exams_taken (a unique
+    constraint) are reported as duplicates rather than stored again.
     """
-    soltn_file_data = open(course_data.solution_filename, 'r')
-    actual_solution_data = json.load(soltn_file_data)
-    soltn_file_data.close()
-    arity = len(actual_solution_data)
-    if arity != len(user_solution_array):
-        raise ValueError('Unequal data length for course {} with ID: {}'
-                         .format(course_data.name, course_data.id))
-    score = 0
-    for i in range(0, arity):
-        if int(actual_solution_data[i]) == int(user_solution_array[i]):
-            score += 1
-    return score, arity
+    def __init__(self, database_handle, logger, size=batch_size, interval=flush_interval):
+        self.database_handle = database_handle
+        self.logger = logger
+        self.size = size
+        self.interval = interval
+        self.papers = []
+        self.started = None
+
+    def __len__(self):
+        return len(self.papers)
+
+    def add(self, paper):
+        if len(self.papers) == 0:
+            self.started = time.time()
+        self.papers.append(paper)
+
+    def is_due(self):
+        if len(self.papers) == 0:
+            return False
+        return len(self.papers) >= self.size or (time.time() - self.started) >= self.interval
+
+    def insert(self, rows):
+        self.database_handle.session.execute(ExamTaken.__table__.insert(), rows)
+        self.database_handle.session.commit()
+
+    def stored_takers(self, papers):
+        takers = list(set(taker_of(paper) for paper in papers))
+        query = self.database_handle.session.query(ExamTaken.course_id, ExamTaken.participant_id)\
+            .filter(tuple_(ExamTaken.course_id, ExamTaken.participant_id).in_(takers))
+        return set((course_id, user_id) for course_id, user_id in query)
+
+    def is_stored(self, paper):
+        try:
+            return len(self.stored_takers([paper])) != 0
+        except Exception:
+            self.database_handle.session.rollback()
+            return False
+
+    def split_duplicates(self, papers):
+        stored, new_papers, duplicates = self.stored_takers(papers), [], []
+        for paper in papers:
+            if taker_of(paper) in stored:
+                duplicates.append(paper)
+            else:
+                stored.add(taker_of(paper))
+                new_papers.append(paper)
+        return new_papers, duplicates
+
+    def flush(self):
+        """:return: a tuple of the papers stored, those that failed and those stored before."""
+        papers, self.papers = self.papers, []
+        if len(papers) == 0:
+            return [], [], []
+        duplicates = []
+        try:
+            papers, duplicates = self.split_duplicates(papers)
+            if len(papers) != 0:
+                self.insert([exam_taken_row(paper) for paper in papers])
+            return papers, [], duplicates
+        except Exception as exc:
+            self.database_handle.session.rollback()
+            self.logger.write('{}: Batch of {} rejected, retrying row by row: {}\n'
+                              .format(datetime.utcnow(), len(papers), str(exc)))
+        persisted, failed = [], []
+        for paper in papers:
+            try:
+                self.insert([exam_taken_row(paper)])
+                persisted.append(paper)
+            except Exception as exc:
+                self.database_handle.session.rollback()
+                if self.is_stored(paper):  # e.g. by the marker it was reclaimed from
+                    duplicates.append(paper)
+                    continue
+                self.logger.write('{}: Error({}): {}\n'.format(datetime.utcnow(), paper['key'], str(exc)))
+                failed.append(paper)
+        return persisted, failed, duplicates
 
 
 app = create_app()
 db = SQLAlchemy()
 db.init_app(app)
+answer_keys = AnswerKeyCache(db, data_cache)
 
 
-def main(logger):
-    time.sleep(10)
-    with app.app_context():
-        while True:
-            paper_keys = data_cache.hkeys(pending_paper_key)
-            if len(paper_keys) == 0:
-                logger.flush()
-                time.sleep(sleep_time)
-            for user_paper in paper_keys:
-                user_data_string = data_cache.hget(pending_paper_key, user_paper)
-                user_data_object = json.loads(user_data_string)
-
-                user_answers_string = user_data_object.get('data')
-                user_solution_object = json.loads(user_answers_string)
-                course_id = long(user_data_object.get('course_id'))
-                user_id = long(user_data_object.get('user_id'))
-                owner_id = long(user_data_object.get('owner_id'))
-                date_taken = user_data_object.get('date_taken')
+def flush_exam_batch(exam_batch, failures, logger):
+    """
+    Stores the batch and counts its scores. Duplicates are only acknowledged: their scores were
+    counted when they were first stored, and their students keep their places in the takers.
+    """
+    persisted, failed, duplicates = exam_batch.flush()
+    failures.extend((paper['key'], paper['raw']) for paper in failed)
+    if len(duplicates) != 0:
+        logger.write('{}: Acknowledged {} papers stored before\n'.format(datetime.utcnow(), len(duplicates)))
+    if len(persisted) == 0 and len(duplicates) == 0:
+        return
+    scores_per_course = {}
+    for paper in persisted:
+        scores_per_course.setdefault(paper['course_id'], []).append((paper['score'], paper['total']))
+    pipe = data_cache.pipeline(transaction=False)
+    for course_id, scores in scores_per_course.items():
+        pipe.zincrby(courses_taken, len(scores), course_id)
+        record_scores(pipe, course_id, scores)
+        invalidate_item_analysis(pipe, course_id)
+    acknowledge_papers(pipe, [paper['key'] for paper in persisted + duplicates])
+    record_processed(pipe, PAPERS, [paper_enqueue_time(paper['key']) for paper in persisted + duplicates])
+    pipe.execute()
+
+
+def failed_takers(failures):
+    for user_paper, user_data_string in failures:
+        try:
+            paper = unpack(PAPER, user_data_string)
+        except (ValueError, TypeError):
+            continue
+        if paper['course_id'] is not None and paper['user_id'] is not None:
+            yield paper['course_id'], paper['user_id']
 
+
+def park_failures(failures):
+    """
+    Moves papers that could not be marked to tuq:error_unmarked_papers. They give their students'
+    places in tuq:course_takers up, so a student is not locked out of a course by a paper that
+    never reached exams_taken; dead_letters.py takes the place back when it replays one.
+    """
+    if len(failures) == 0:
+        return
+    pipe = data_cache.pipeline(transaction=False)
+    pipe.hmset(error_marking_key, dict(failures))
+    for course_id, user_id in failed_takers(failures):
+        release_taken(pipe, course_id, user_id)
+    acknowledge_papers(pipe, [user_paper for user_paper, _ in failures])
+    record_processed(pipe, PAPERS, [paper_enqueue_time(user_paper) for user_paper, _ in failures], len(failures))
+    pipe.execute()
+
+
+class Shutdown(object):
+    """
+    Set by SIGTERM/SIGINT. A worker finishes the batch in hand and exits; with `drain` it keeps
+    reading its shards without blocking until they are empty.
+    """
+    def __init__(self, drain):
+        self.drain = drain
+        self.requested = False
+
+    def request(self, signum, frame):
+        self.requested = True
+
+
+def main(logger, shards, shutdown):
+    exam_batch = ExamTakenBatch(db, logger)
+    consumer = consumer_name()
+    ensure_marker_group(data_cache, shards)
+    busy, last_reclaim = False, 0
+    with app.app_context():
+        while not (shutdown.requested and not shutdown.drain):
+            entries = []
+            if time.time() - last_reclaim >= reclaim_interval:
+                entries, poison_entries = reclaim_papers(data_cache, consumer, shards, batch_size)
+                park_failures(poison_entries)
+                removed = remove_dead_consumers(data_cache, consumer, shards)
+                if removed != 0:
+                    logger.write('{}: Removed {} dead consumers\n'.format(datetime.utcnow(), removed))
+                last_reclaim = time.time()
+            if len(entries) == 0:
                 try:
-                    course_data = grab_course_data(course_id, db)
-                    score, total = mark_paper(course_data, user_solution_object)
-                    exam_taken = ExamTaken(course_id=course_id, participant_id=user_id,
-                                           date_taken=date_taken, other_data=user_answers_string,
-                                           score=score, course_owner=owner_id, total_score=total)
-                    db.session.add(exam_taken)
-                    db.session.commit()
-                    data_cache.zincrby(courses_taken, course_id, 1)
-                except Exception as exc:
-                    logger.write('{}: Error({}): {}\n'.format(datetime.utcnow(), user_paper, str(exc)))
-                    data_cache.hset(error_marking_key, user_paper, user_data_string)
-                data_cache.hdel(pending_paper_key, user_paper)
-
-
-event_logger = open('./logs.txt', 'a')
-new_thread = Thread(target=main, args=[event_logger])
-new_thread.setDaemon(True)
-new_thread.start()
+                    entries = read_papers(data_cache, consumer, shards, batch_size,
+                                          None if shutdown.requested else block_time_ms)
+                except redis.exceptions.ConnectionError:
+                    if not shutdown.requested:  # a blocking read interrupted by the signal
+                        raise
+                    continue
+            if len(entries) == 0:
+                if busy:
+                    logger.write('{}: Answer keys: {}\n'.format(datetime.utcnow(), answer_keys.stats()))
+                    logger.flush()
+                busy = False
+                if shutdown.requested:
+                    break
+                continue
+            busy = True
+            answer_keys.refresh_versions()
+            failures = []
+            papers_by_course = group_papers_by_course(entries, failures, logger)
+            for course_id, papers in papers_by_course.items():
+                for paper in mark_course_papers(course_id, papers, failures, logger):
+                    exam_batch.add(paper)
+                    if exam_batch.is_due():
+                        flush_exam_batch(exam_batch, failures, logger)
+            flush_exam_batch(exam_batch, failures, logger)
+            park_failures(failures)
+    logger.write('{}: Marker on shards {} stopped\n'.format(datetime.utcnow(), shards))
+    logger.flush()
+
+
+def run_worker(worker_index, worker_count, drain):
+    shutdown = Shutdown(drain)
+    signal.signal(signal.SIGTERM, shutdown.request)
+    signal.signal(signal.SIGINT, shutdown.request)
+    logger = open('./logs.txt', 'a', 1)
+    main(logger, shards_for_worker(worker_index, worker_count), shutdown)
+
+
+def start_worker(worker_index, worker_count, drain):
+    worker = Process(target=run_worker, args=(worker_index, worker_count, drain),
+                     name='PaperMarker-{}'.format(worker_index))
+    worker.start()
+    return worker
+
+
+def run_pool(worker_count, drain):
+    """
+    Starts one marker process per shard group and restarts any that die, until SIGTERM/SIGINT,
+    which is passed on to the workers before waiting for them to finish.
+    """
+    moved = move_legacy_papers(data_cache)
+    if moved != 0:
+        print('Moved {} papers from the legacy queues'.format(moved))
+    shutdown = Shutdown(drain)
+    signal.signal(signal.SIGTERM, shutdown.request)
+    signal.signal(signal.SIGINT, shutdown.request)
+    workers = [start_worker(index, worker_count, drain) for index in range(worker_count)]
+    while not shutdown.requested:
+        time.sleep(1)
+        for index, worker in enumerate(workers):
+            if not worker.is_alive() and not shutdown.requested:
+                print('Marker {} exited with {}, restarting'.format(index, worker.exitcode))
+                workers[index] = start_worker(index, worker_count, drain)
+    for worker in workers:
+        if worker.is_alive():
+            os.kill(worker.pid, signal.SIGTERM)
+    for worker in workers:
+        worker.join()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Marks submitted papers with a pool of worker processes')
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count(),
+                        help='number of marker processes (default: number of CPUs)')
+    parser.add_argument('--drain', action='store_true',
+                        help='on SIGTERM, mark everything already queued before exiting')
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
-    app.run(port=3457, debug=True)
+    arguments = parse_arguments()
+    run_pool(max(1, min(arguments.workers, stream_shards)), arguments.drain)
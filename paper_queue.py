@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  paper_queue.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from redis.exceptions import ResponseError
+from payloads import unpack, PAPER
+from lua_scripts import LuaScript
+import os
+import socket
+
+
+# papers are spread over this many streams by course id, so each marker worker owns a fixed set
+# of courses and keeps their answer keys hot. Changing it requires draining the streams first.
+stream_shards = int(os.environ.get('PAPER_STREAM_SHARDS', 16))
+paper_stream_format = 'tuq:paper_stream:{shard}'
+marker_group = 'tuq:markers'
+legacy_pending_paper_key = 'tuq:pending_papers'
+legacy_paper_stream_key = 'tuq:paper_stream'
+# entries left un-acked this long by a consumer are considered abandoned and handed to another
+reclaim_idle_ms = int(os.environ.get('MARKER_RECLAIM_IDLE_MS', 60 * 1000))
+# how often a marker looks for abandoned entries and for consumers left behind by dead processes
+reclaim_interval = float(os.environ.get('MARKER_RECLAIM_INTERVAL', 30))
+consumer_idle_ms = int(os.environ.get('MARKER_CONSUMER_IDLE_MS', 60 * 60 * 1000))
+# after this many deliveries an entry is treated as poison and dead-lettered
+max_deliveries = int(os.environ.get('MARKER_MAX_DELIVERIES', 5))
+# how long a client-supplied submission id is remembered for deduplicating retries
+submission_ttl = int(os.environ.get('SUBMISSION_ID_TTL', 60 * 60 * 24))
+submission_key_format = 'tuq:submissions:{user_id}:{course_id}:{submission_id}'
+# a web process marking a paper inline holds its submission key with this claim, which expires
+# soon so a process that dies mid-mark does not hold it for long
+inline_marking_claim = 'marking'
+inline_claim_ttl = int(os.environ.get('INLINE_CLAIM_TTL', 30))
+
+# participant ids of everyone who has submitted the course, whether marked or still queued; a paper
+# parked in tuq:error_unmarked_papers gives its place up until it is replayed
+course_takers_format = 'tuq:course_takers:{course_id}'
+QUEUED, RETRIED, ALREADY_TAKEN = (1, 0, -1)
+
+# KEYS[1] = submission key, KEYS[2] = stream, KEYS[3] = course takers;
+# ARGV[1] = paper, ARGV[2] = ttl, ARGV[3] = user id, ARGV[4] = inline marking claim
+# returns {QUEUED, entry id}, {RETRIED, entry id of the first attempt} or {ALREADY_TAKEN, ''}.
+# A paper claimed for inline marking is queued without checking the takers, which the inline
+# marker has already joined: it may have died mid-mark, and if not the marker stores the paper once.
+submit_once_script = LuaScript("""
+local existing = redis.call('GET', KEYS[1])
+if existing and existing ~= ARGV[4] then
+    return {0, existing}
+end
+if not existing and redis.call('SADD', KEYS[3], ARGV[3]) == 0 then
+    return {-1, ''}
+end
+local entry_id = redis.call('XADD', KEYS[2], '*', 'paper', ARGV[1], 'submission', KEYS[1])
+redis.call('SET', KEYS[1], entry_id, 'EX', ARGV[2])
+return {1, entry_id}
+""")
+
+# KEYS[1] = stream, KEYS[2] = course takers; ARGV[1] = paper, ARGV[2] = user id
+# returns 1 if the paper was queued, 0 if the student has submitted the course again meanwhile
+requeue_script = LuaScript("""
+if redis.call('SADD', KEYS[2], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('XADD', KEYS[1], '*', 'paper', ARGV[1])
+return 1
+""")
+
+
+def consumer_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def shard_for_course(course_id):
+    return int(course_id) % stream_shards
+
+
+def shards_for_worker(worker_index, worker_count):
+    return [shard for shard in range(stream_shards) if shard % worker_count == worker_index]
+
+
+def paper_stream(shard):
+    return paper_stream_format.format(shard=shard)
+
+
+def paper_key(shard, entry_id):
+    """
+    Entry ids are only unique within a stream, so a paper is identified by both; this is also
+    the field name used for it in tuq:error_unmarked_papers.
+    """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    return '{}@{}'.format(entry_id, shard)
+
+
+def split_paper_key(key):
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    entry_id, shard = key.rsplit('@', 1)
+    return int(shard), entry_id
+
+
+def enqueue_paper(data_cache, data_string, course_id):
+    return data_cache.xadd(paper_stream(shard_for_course(course_id)), {'paper': data_string})
+
+
+def submit_paper(data_cache, data_string, user_id, course_id, submission_id):
+    """
+    Queues one submission, keyed by (user, course, submission id). A retry carrying the same
+    submission id is not queued again, and neither is a second submission of the same course.
+    :return: a tuple of QUEUED, RETRIED or ALREADY_TAKEN and the stream entry id.
+    """
+    submission_key = submission_key_format.format(user_id=user_id, course_id=course_id,
+                                                  submission_id=submission_id)
+    status, entry_id = submit_once_script(data_cache, [submission_key, paper_stream(shard_for_course(course_id)),
+                                                       course_takers_format.format(course_id=course_id)],
+                                          [data_string, submission_ttl, user_id, inline_marking_claim])
+    return status, entry_id
+
+
+def requeue_paper(data_cache, data_string, user_id, course_id):
+    """Queues a parked paper again, taking its student's place in the course takers back."""
+    return requeue_script(data_cache, [paper_stream(shard_for_course(course_id)),
+                                       course_takers_format.format(course_id=course_id)], [data_string, user_id])
+
+
+def ensure_marker_group(data_cache, shards):
+    for shard in shards:
+        try:
+            data_cache.xgroup_create(paper_stream(shard), marker_group, id='0', mkstream=True)
+        except ResponseError as exc:
+            if 'BUSYGROUP' not in str(exc):
+                raise
+
+
+def course_of(data_string):
+    return unpack(PAPER, data_string)['course_id']
+
+
+def move_legacy_papers(data_cache):
+    """
+    Papers queued in the old tuq:pending_papers hash or the old unsharded stream are moved onto
+    their shard, so nothing submitted during a deployment is lost. Run it while no marker is up.
+    """
+    legacy_papers = list(data_cache.hgetall(legacy_pending_paper_key).items())
+    legacy_entries = data_cache.xrange(legacy_paper_stream_key) if data_cache.exists(legacy_paper_stream_key) else []
+    if len(legacy_papers) == 0 and len(legacy_entries) == 0:
+        return 0
+    pipe = data_cache.pipeline()
+    for user_paper, data_string in legacy_papers:
+        enqueue_paper(pipe, data_string, course_of(data_string))
+        pipe.hdel(legacy_pending_paper_key, user_paper)
+    for entry_id, data_string in entries_to_papers(legacy_entries):
+        enqueue_paper(pipe, data_string, course_of(data_string))
+    if len(legacy_entries) != 0:
+        pipe.delete(legacy_paper_stream_key)
+    pipe.execute()
+    return len(legacy_papers) + len(legacy_entries)
+
+
+def entries_to_papers(entries):
+    return [(entry_id, fields.get(b'paper')) for entry_id, fields in entries if fields]
+
+
+def read_papers(data_cache, consumer, shards, count, block_ms):
+    """
+    Reads new entries from all of the worker's shards in one XREADGROUP; block_ms of None returns
+    at once when there is nothing new.
+    """
+    streams = dict((paper_stream(shard), '>') for shard in shards)
+    response = data_cache.xreadgroup(marker_group, consumer, streams, count=count, block=block_ms)
+    papers = []
+    for stream, entries in response or []:
+        shard = int(stream.rsplit(b':', 1)[1])
+        papers.extend((paper_key(shard, entry_id), data_string)
+                      for entry_id, data_string in entries_to_papers(entries))
+    return papers
+
+
+def reclaim_papers(data_cache, consumer, shards, count):
+    """
+    Claims entries another consumer read but never acknowledged (e.g. it crashed mid-batch). The
+    pending lists of all the shards are fetched in one pipeline.
+    :return: a tuple of the claimed papers to be marked again and the claimed papers that have
+    been delivered too many times already and should be dead-lettered.
+    """
+    pipe = data_cache.pipeline(transaction=False)
+    for shard in shards:
+        pipe.xpending_range(paper_stream(shard), marker_group, '-', '+', count)
+    papers, poison_papers = [], []
+    for shard, pending in zip(shards, pipe.execute()):
+        stream = paper_stream(shard)
+        stale = dict((entry['message_id'], entry['times_delivered']) for entry in pending
+                     if entry['time_since_delivered'] >= reclaim_idle_ms)
+        if len(stale) == 0:
+            continue
+        entries = data_cache.xclaim(stream, marker_group, consumer, reclaim_idle_ms, list(stale.keys()))
+        claimed = entries_to_papers(entries)
+        for entry_id, data_string in claimed:
+            if stale.get(entry_id, 0) >= max_deliveries:
+                poison_papers.append((paper_key(shard, entry_id), data_string))
+            else:
+                papers.append((paper_key(shard, entry_id), data_string))
+        acknowledge_deleted(data_cache, stream, set(stale.keys()) - set(entry_id for entry_id, _ in claimed))
+    return papers, poison_papers
+
+
+def remove_dead_consumers(data_cache, consumer, shards):
+    """
+    Every marker process joins the group under its own host and pid, so restarts leave consumers
+    behind. Those idle for longer than consumer_idle_ms with nothing pending are deleted; the
+    ones still holding entries stay until reclaim_papers has taken them over.
+    :return: the number of consumers deleted.
+    """
+    pipe = data_cache.pipeline(transaction=False)
+    for shard in shards:
+        pipe.xinfo_consumers(paper_stream(shard), marker_group)
+    dead = []
+    for shard, consumers in zip(shards, pipe.execute()):
+        dead.extend((shard, info['name']) for info in consumers
+                    if info['pending'] == 0 and info['idle'] >= consumer_idle_ms
+                    and info['name'] != consumer.encode('utf-8'))
+    if len(dead) == 0:
+        return 0
+    for shard, name in dead:
+        pipe.xgroup_delconsumer(paper_stream(shard), marker_group, name)
+    pipe.execute()
+    return len(dead)
+
+
+def acknowledge_deleted(data_cache, stream, entry_ids):
+    """
+    XCLAIM returns an entry deleted from the stream without its fields, but leaves it pending, so
+    it would be reclaimed forever. Entries that are really gone are acknowledged; the others were
+    only claimed by another consumer in the meantime and are left alone.
+    """
+    entry_ids = list(entry_ids)
+    if len(entry_ids) == 0:
+        return
+    pipe = data_cache.pipeline(transaction=False)
+    for entry_id in entry_ids:
+        pipe.xrange(stream, entry_id, entry_id, count=1)
+    deleted = [entry_id for entry_id, found in zip(entry_ids, pipe.execute()) if len(found) == 0]
+    if len(deleted) != 0:
+        data_cache.xack(stream, marker_group, *deleted)
+
+
+def acknowledge_papers(pipe, keys):
+    """Queues the XACK and XDEL of finished entries on the caller's pipeline."""
+    entries_by_shard = {}
+    for key in keys:
+        shard, entry_id = split_paper_key(key)
+        entries_by_shard.setdefault(shard, []).append(entry_id)
+    for shard, entry_ids in entries_by_shard.items():
+        pipe.xack(paper_stream(shard), marker_group, *entry_ids)
+        pipe.xdel(paper_stream(shard), *entry_ids)
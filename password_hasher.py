@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  password_hasher.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from werkzeug.security import generate_password_hash, check_password_hash
+from multiprocessing import Pool, TimeoutError, cpu_count
+from threading import BoundedSemaphore, Lock
+import os
+
+
+# raising the iteration count only affects new hashes; older ones are upgraded as users log in
+hash_iterations = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 50000))
+hash_method = 'pbkdf2:sha256:{}'.format(hash_iterations)
+# every web worker process starts its own pool, so together they get the host's CPUs
+web_workers = int(os.environ.get('WEB_WORKERS', 1))
+pool_size = int(os.environ.get('PASSWORD_POOL_SIZE', max(1, cpu_count() // web_workers)))
+# requests waiting on the pool at once before new ones are turned away, and how long each waits
+max_pending = int(os.environ.get('PASSWORD_MAX_PENDING', pool_size * 8))
+hash_timeout = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=hash_method)
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != hash_method
+
+
+def verify_and_upgrade(password_hash, password):
+    """:return: whether the password matches, and its new hash if the stored one used another cost."""
+    if not check_password_hash(password_hash, password):
+        return False, None
+    return True, hash_password(password) if needs_rehash(password_hash) else None
+
+
+def call_safely(call):
+    # Pool only runs the callback of a call that succeeds, so errors are returned instead
+    func, args = call
+    try:
+        return True, func(*args)
+    except Exception as exc:
+        return False, exc
+
+
+def result_of(outcome):
+    succeeded, value = outcome
+    if not succeeded:
+        raise value
+    return value
+
+
+class PasswordHasher(object):
+    """
+    Runs PBKDF2 in a process pool so hashing never holds a web worker's CPU, and refuses work with
+    HasherBusy once `max_pending` calls are in the pool or a call takes longer than `timeout`. A
+    call's slot is released when the pool finishes it, not when its caller stops waiting, so calls
+    that timed out still count. The pool is started on first use in each process, so forked web
+    workers get their own.
+    """
+    def __init__(self, processes=pool_size, max_pending=max_pending, timeout=hash_timeout):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.slots = None
+        self.lock = Lock()
+        self.pool = None
+        self.pid = None
+
+    def get_pool(self):
+        """:return: the process's pool and its slots; calls in flight in a parent never finish here."""
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool, self.pid = Pool(self.processes), os.getpid()
+                self.slots = BoundedSemaphore(self.max_pending)
+            return self.pool, self.slots
+
+    def acquire(self):
+        pool, slots = self.get_pool()
+        if not slots.acquire(False):
+            raise HasherBusy('Too many password operations pending')
+        return pool, slots
+
+    def wait(self, pending, timeout):
+        try:
+            return pending.get(timeout)
+        except TimeoutError:
+            raise HasherBusy('Password operation timed out')
+
+    def run(self, func, *args):
+        pool, slots = self.acquire()
+        try:
+            pending = pool.apply_async(call_safely, ((func, args),), callback=lambda outcome: slots.release())
+        except Exception:
+            slots.release()
+            raise
+        return result_of(self.wait(pending, self.timeout))
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def hash_many(self, passwords):
+        if len(passwords) == 0:
+            return []
+        pool, slots = self.acquire()
+        try:
+            pending = pool.map_async(call_safely, [(hash_password, (password,)) for password in passwords],
+                                     callback=lambda outcomes: slots.release())
+        except Exception:
+            slots.release()
+            raise
+        return [result_of(outcome) for outcome in self.wait(pending, self.timeout * len(passwords))]
+
+    def verify(self, password_hash, password):
+        if not password_hash or not password:
+            return False, None
+        return self.run(verify_and_upgrade, password_hash, password)
+
+
+password_hasher = PasswordHasher()
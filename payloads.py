@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  payloads.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+import msgpack
+import json
+
+
+# every queued item is a msgpack array [version, kind, values, meta]; values follow the kind's
+# schema order so field names are not repeated in each payload, meta holds queue bookkeeping
+# such as 'replay_attempts'. Fields are only ever appended to a schema, so older payloads still
+# decode, with the new fields set to None
+envelope_version = 1
+PAPER, CONFIRMATION, ADMIN_REQUEST = ('paper', 'confirmation', 'admin_request')
+schemas = {
+    PAPER: ('user_id', 'owner_id', 'course_id', 'answers', 'date_taken', 'submission_id'),
+    CONFIRMATION: ('email', 'user_id', 'fullname'),
+    # 'password' is only set by payloads queued before the web tier hashed it into 'password_hash'
+    ADMIN_REQUEST: ('username', 'fullname', 'address', 'email', 'nationality', 'alias', 'mobile',
+                    'password', 'password_hash', 'reservation'),
+}
+
+
+def pack(kind, record, meta=None):
+    schema = schemas[kind]
+    unknown = set(record.keys()) - set(schema)
+    if len(unknown) != 0:
+        raise ValueError('Unknown {} fields: {}'.format(kind, ', '.join(sorted(unknown))))
+    values = [record.get(field) for field in schema]
+    return msgpack.packb([envelope_version, kind, values, meta or {}], use_bin_type=True)
+
+
+def unpack_legacy(kind, data):
+    """Reads the JSON payloads queued before the envelope existed."""
+    record = json.loads(data)
+    meta = {}
+    if 'replay_attempts' in record:
+        meta['replay_attempts'] = record.pop('replay_attempts')
+    if kind == PAPER and 'data' in record:
+        record['answers'] = json.loads(record.pop('data'))
+    return dict((field, record.get(field)) for field in schemas[kind]), meta
+
+
+def unpack_with_meta(kind, data):
+    """
+    :return: a tuple of the record as a dict of its schema's fields, and the envelope's meta.
+    :raise ValueError: if `data` is not a payload of the given kind.
+    """
+    if data[:1] in (b'{', '{'):
+        return unpack_legacy(kind, data)
+    try:
+        version, payload_kind, values, meta = msgpack.unpackb(data, raw=False)
+    except (msgpack.exceptions.ExtraData, TypeError, ValueError) as exc:
+        raise ValueError('Malformed payload: {}'.format(exc))
+    if version > envelope_version:
+        raise ValueError('Unsupported payload version {}'.format(version))
+    if payload_kind != kind:
+        raise ValueError('Expected a {} payload, got {}'.format(kind, payload_kind))
+    record = dict.fromkeys(schemas[kind])
+    record.update(zip(schemas[kind], values))
+    return record, meta
+
+
+def unpack(kind, data):
+    return unpack_with_meta(kind, data)[0]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  queue_metrics.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from paper_queue import paper_stream, stream_shards, marker_group, split_paper_key
+import argparse
+import redis
+import json
+import time
+import os
+
+
+PAPERS, CONFIRMATION_EMAILS, ADMIN_REQUESTS = ('papers', 'confirmation_emails', 'admin_requests')
+hash_queue_keys = {ADMIN_REQUESTS: 'tuq:admin_requests'}
+list_queue_keys = {CONFIRMATION_EMAILS: 'tuq:confirmation_email_queue'}
+# field -> enqueue time, for queues kept in hashes and lists; stream entry ids carry their own timestamp
+enqueued_at_format = 'tuq:enqueued_at:{queue}'
+counters_format = 'tuq:metrics:{queue}'
+latency_format = 'tuq:metrics:{queue}:latency'
+# minute -> items processed, one hash per hour so old minutes expire with their hash
+per_minute_format = 'tuq:metrics:{queue}:per_minute:{hour}'
+# upper bounds, in seconds, of the processing latency histogram buckets
+latency_buckets = (0.1, 0.5, 1, 5, 30, 60, 300, 1800)
+per_minute_retention = 60 * 60 * 24  # seconds
+throughput_window = 5  # minutes
+
+
+def latency_bucket(seconds):
+    for bound in latency_buckets:
+        if seconds <= bound:
+            return str(bound)
+    return '+Inf'
+
+
+def record_enqueued(data_cache, queue, field):
+    data_cache.zadd(enqueued_at_format.format(queue=queue), {field: time.time()})
+
+
+def take_enqueue_times(data_cache, queue, fields):
+    """Returns when each field was queued (None if unknown) and forgets them, in one round trip."""
+    if len(fields) == 0:
+        return []
+    key = enqueued_at_format.format(queue=queue)
+    pipe = data_cache.pipeline(transaction=False)
+    for field in fields:
+        pipe.zscore(key, field)
+    pipe.zrem(key, *fields)
+    return pipe.execute()[:-1]
+
+
+def paper_enqueue_time(key):
+    shard, entry_id = split_paper_key(key)
+    return int(entry_id.split('-')[0]) / 1000.0
+
+
+def record_processed(pipe, queue, enqueue_times, errors=0):
+    """
+    Adds one batch to the queue's counters and latency histogram; pipe is the caller's pipeline
+    so this costs no extra round trip.
+    """
+    now = time.time()
+    minute = int(now // 60)
+    counters_key, latency_key = counters_format.format(queue=queue), latency_format.format(queue=queue)
+    per_minute_key = per_minute_format.format(queue=queue, hour=minute // 60)
+    processed = len(enqueue_times)
+    pipe.hincrby(counters_key, 'processed', processed)
+    if errors != 0:
+        pipe.hincrby(counters_key, 'errors', errors)
+    histogram = {}
+    for enqueued in enqueue_times:
+        if enqueued is not None:
+            bucket = latency_bucket(now - float(enqueued))
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+    for bucket, count in histogram.items():
+        pipe.hincrby(latency_key, bucket, count)
+    pipe.hincrby(per_minute_key, minute, processed)
+    pipe.expire(per_minute_key, per_minute_retention + 60 * 60)
+
+
+def throughput(data_cache, queue):
+    """Items per second over the last `throughput_window` complete minutes."""
+    current_minute = int(time.time() // 60)
+    window = range(current_minute - throughput_window, current_minute)
+    pipe = data_cache.pipeline(transaction=False)
+    for minute in window:
+        pipe.hget(per_minute_format.format(queue=queue, hour=minute // 60), minute)
+    return sum(int(count or 0) for count in pipe.execute()) / (throughput_window * 60.0)
+
+
+def paper_queue_state(data_cache):
+    depth, pending, oldest = 0, 0, None
+    for shard in range(stream_shards):
+        stream = paper_stream(shard)
+        if not data_cache.exists(stream):
+            continue
+        depth += data_cache.xlen(stream)
+        pending += data_cache.xpending(stream, marker_group).get('pending', 0)
+        first = data_cache.xrange(stream, count=1)
+        if first:
+            enqueued = int(first[0][0].split(b'-')[0]) / 1000.0
+            oldest = enqueued if oldest is None else min(oldest, enqueued)
+    return {'depth': depth, 'in_flight': pending, 'oldest_enqueued': oldest}
+
+
+def keyed_queue_state(data_cache, queue):
+    oldest = data_cache.zrange(enqueued_at_format.format(queue=queue), 0, 0, withscores=True)
+    if queue in hash_queue_keys:
+        depth = data_cache.hlen(hash_queue_keys[queue])
+    else:
+        depth = data_cache.llen(list_queue_keys[queue])
+    return {'depth': depth, 'oldest_enqueued': oldest[0][1] if oldest else None}
+
+
+def queue_report(data_cache):
+    states = {PAPERS: paper_queue_state(data_cache)}
+    for queue in list(hash_queue_keys.keys()) + list(list_queue_keys.keys()):
+        states[queue] = keyed_queue_state(data_cache, queue)
+    now = time.time()
+    for queue, state in states.items():
+        oldest = state.pop('oldest_enqueued')
+        state['oldest_age'] = now - oldest if oldest is not None else 0
+        counters = data_cache.hgetall(counters_format.format(queue=queue))
+        state['processed'] = int(counters.get(b'processed', 0))
+        state['errors'] = int(counters.get(b'errors', 0))
+        state['items_per_second'] = throughput(data_cache, queue)
+        latency = data_cache.hgetall(latency_format.format(queue=queue))
+        state['latency'] = dict((bucket.decode('utf-8'), int(count)) for bucket, count in latency.items())
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints depth, lag and throughput of every broker queue')
+    parser.add_argument('--json', action='store_true', help='print machine readable output')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help="exit with status 1 when any queue's oldest item is older than this many seconds")
+    arguments = parser.parse_args()
+    cache_pass, port_number = os.environ.get('redis_pass'), int(os.environ.get('redis_port'))
+    report = queue_report(redis.StrictRedis(password=cache_pass, port=port_number))
+    if arguments.json:
+        print(json.dumps(report, sort_keys=True))
+    else:
+        for queue, state in sorted(report.items()):
+            print('{}: depth={} oldest={:.1f}s rate={:.2f}/s processed={} errors={} latency={}'.format(
+                queue, state['depth'], state['oldest_age'], state['items_per_second'], state['processed'],
+                state['errors'], state['latency']))
+    if arguments.max_age is not None and any(state['oldest_age'] > arguments.max_age for state in report.values()):
+        exit(1)
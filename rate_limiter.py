@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  rate_limiter.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from threading import Lock
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` operations per second on average, with bursts of up to `capacity`. Safe to share
+    between threads.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = Lock()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take_up_to(self, wanted):
+        """Takes as many whole tokens as are available, up to `wanted`, without waiting."""
+        with self.lock:
+            self.refill()
+            granted = int(min(wanted, self.tokens))
+            self.tokens -= granted
+            return granted
+
+    def give_back(self, tokens):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def acquire(self, tokens=1):
+        """Waits until `tokens` are available and takes them."""
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
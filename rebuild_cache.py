@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  rebuild_cache.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from models import User, Course, Repository, ExamTaken
+from resources import well_known_courses
+from sqlalchemy import func
+from course_cache import course_metadata, announce_course_change
+from datetime import datetime
+import json_codec
+import argparse
+
+
+rebuild_suffix = ':rebuild'
+batch_size = 5000
+# how many differences of each kind verify prints per key
+report_limit = 20
+
+
+def streamed(query):
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def user_column(column):
+    def rows(database_handle):
+        for (value,) in streamed(database_handle.session.query(column)):
+            if value:
+                yield value
+    return rows
+
+
+def known_course_rows(database_handle):
+    query = database_handle.session.query(Course, User.username)\
+        .outerjoin(Repository, Course.repo_id == Repository.id).outerjoin(User, Repository.owner_id == User.id)
+    for course, owner_username in streamed(query):
+        yield course.id, json_codec.dumps(course_metadata(course, owner_username))
+
+
+def course_rank_rows(database_handle):
+    query = database_handle.session.query(ExamTaken.course_id, func.count(ExamTaken.id)).group_by(ExamTaken.course_id)
+    for course_id, taken in streamed(query):
+        yield course_id, taken
+
+
+def canonical_course(value):
+    course = json_codec.loads(value)
+    if isinstance(course.get('departments'), list):
+        course['departments'] = sorted(course['departments'])
+    return course
+
+
+def same_course(expected, actual):
+    """Every cached course has the course_metadata shape, so all of it is compared; department order aside."""
+    return canonical_course(expected) == canonical_course(actual)
+
+
+class KeySwap(object):
+    """
+    Rebuilds Redis keys out of sight: write() sends each command to the ':rebuild' temporary copy
+    of its key through one pipeline, flushed every batch_size commands, and swap() renames the
+    copies over the live keys, so readers see either the old or the new contents.
+    """
+    def __init__(self, data_cache):
+        self.pipe = data_cache.pipeline(transaction=False)
+        self.pending = 0
+        self.keys = set()
+
+    def queue(self, command, *args):
+        getattr(self.pipe, command)(*args)
+        self.pending += 1
+        if self.pending >= batch_size:
+            self.pipe.execute()
+            self.pending = 0
+
+    def write(self, command, key, *args):
+        if key not in self.keys:
+            self.keys.add(key)
+            self.queue('delete', key + rebuild_suffix)
+        self.queue(command, key + rebuild_suffix, *args)
+
+    def swap(self, live_keys=()):
+        """
+        Renames every rebuilt key over its live key, and deletes those of `live_keys` (e.g. a SCAN
+        of the family) that were not rebuilt, as nothing in MySQL backs them any more.
+        :return: the number of keys rebuilt.
+        """
+        self.pipe.execute()
+        self.pending = 0
+        for key in self.keys:
+            self.queue('rename', key + rebuild_suffix, key)
+        for key in live_keys:
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if key not in self.keys and not key.endswith(rebuild_suffix):
+                self.queue('delete', key)
+        self.pipe.execute()
+        return len(self.keys)
+
+
+class DerivedKey(object):
+    """
+    A Redis key that only mirrors MySQL. `rows` yields members for a set, or (field, value) pairs
+    for a hash or a sorted set.
+    """
+    def __init__(self, name, key, kind, rows, same=None, on_rebuild=None):
+        self.name = name
+        self.key = key
+        self.kind = kind
+        self.rows = rows
+        self.same = same or (lambda expected, actual: expected == actual)
+        self.on_rebuild = on_rebuild
+
+    def write(self, swap, row):
+        if self.kind == 'set':
+            swap.write('sadd', self.key, row)
+        elif self.kind == 'hash':
+            swap.write('hset', self.key, row[0], row[1])
+        else:
+            swap.write('zadd', self.key, {row[0]: row[1]})
+
+    def rebuild(self, data_cache, database_handle):
+        """
+        Streams the rows into the key through a KeySwap. Writes made to the live key while it runs
+        are lost in the swap, so run it outside signup and exam windows.
+        """
+        swap, written = KeySwap(data_cache), 0
+        for row in self.rows(database_handle):
+            self.write(swap, row)
+            written += 1
+        swap.swap([self.key])
+        if self.on_rebuild is not None:
+            self.on_rebuild(data_cache)
+        return written
+
+    def expected(self, database_handle):
+        if self.kind == 'set':
+            return dict((u'{}'.format(row), None) for row in self.rows(database_handle))
+        return dict((u'{}'.format(field), value) for field, value in self.rows(database_handle))
+
+    def actual(self, data_cache):
+        if self.kind == 'set':
+            return dict((member.decode('utf-8'), None) for member in data_cache.sscan_iter(self.key, count=batch_size))
+        if self.kind == 'hash':
+            items = data_cache.hscan_iter(self.key, count=batch_size)
+            return dict((field.decode('utf-8'), value.decode('utf-8')) for field, value in items)
+        items = data_cache.zscan_iter(self.key, count=batch_size)
+        return dict((member.decode('utf-8'), int(score)) for member, score in items)
+
+    def verify(self, data_cache, database_handle):
+        """:return: the members missing from Redis, those Redis has in excess and those whose values differ."""
+        expected, actual = self.expected(database_handle), self.actual(data_cache)
+        missing = sorted(set(expected) - set(actual))
+        extra = sorted(set(actual) - set(expected))
+        different = sorted(member for member in set(expected) & set(actual)
+                           if not self.same(expected[member], actual[member]))
+        return missing, extra, different
+
+
+derived_keys = dict((derived.name, derived) for derived in [
+    DerivedKey('usernames', 'tuq:usernames', 'set', user_column(User.username)),
+    DerivedKey('emails', 'tuq:emails', 'set', user_column(User.email)),
+    DerivedKey('phones', 'tuq:phones', 'set', user_column(User.phone_number)),
+    DerivedKey('known_courses', well_known_courses, 'hash', known_course_rows, same_course, announce_course_change),
+    DerivedKey('all_course_rank', 'tuq:all_course_rank', 'zset', course_rank_rows)])
+
+
+def verify(data_cache, database_handle, names):
+    consistent = True
+    for name in names:
+        missing, extra, different = derived_keys[name].verify(data_cache, database_handle)
+        print('{}: {} missing, {} extra, {} different'.format(name, len(missing), len(extra), len(different)))
+        for label, members in (('missing', missing), ('extra', extra), ('different', different)):
+            if len(members) != 0:
+                print('  {}: {}'.format(label, ', '.join(members[:report_limit])))
+        consistent = consistent and not (missing or extra or different)
+    return consistent
+
+
+if __name__ == '__main__':
+    from init_file import create_app
+    from resources import data_cache
+    from taken_index import rebuild_taken_index
+    from course_stats import rebuild_course_stats
+    from models import db
+
+    # families of per-course keys, which are rebuilt but not verified
+    rebuild_only = {'course_takers': rebuild_taken_index, 'course_stats': rebuild_course_stats}
+
+    parser = argparse.ArgumentParser(description='Rebuilds or checks the Redis keys derived from MySQL')
+    parser.add_argument('command', choices=['rebuild', 'verify'])
+    parser.add_argument('keys', nargs='*', help='keys to process, all of them by default: {}, and {}, which can '
+                        'only be rebuilt'.format(', '.join(sorted(derived_keys.keys())),
+                                                 ', '.join(sorted(rebuild_only))))
+    arguments = parser.parse_args()
+    names = arguments.keys or sorted(derived_keys.keys()) + sorted(rebuild_only)
+    unknown = [name for name in names if name not in derived_keys and name not in rebuild_only]
+    if len(unknown) != 0:
+        parser.error('unknown keys: {}'.format(', '.join(unknown)))
+    with create_app().app_context():
+        if arguments.command == 'verify':
+            exit(0 if verify(data_cache, db, [name for name in names if name not in rebuild_only]) else 1)
+        for name in names:
+            if name in rebuild_only:
+                courses = rebuild_only[name](data_cache, db)
+                print('{}: Rebuilt {} of {} courses'.format(datetime.utcnow(), name, courses))
+            else:
+                written = derived_keys[name].rebuild(data_cache, db)
+                print('{}: Rebuilt {} with {} entries'.format(datetime.utcnow(), name, written))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  regrader.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from sqlalchemy import select, bindparam, func
+from models import ExamTaken
+from answer_keys import AnswerKeyCache, answers_to_row, mark_papers
+from course_stats import record_scores, course_stats_format
+from item_analysis import invalidate_item_analysis
+from datetime import datetime
+import argparse
+import numpy
+import json
+
+
+regrade_request_key = 'tuq:regrade_requests'
+regrade_progress_format = 'tuq:regrade_progress:{course_id}'
+chunk_size = 1000
+
+
+def request_regrade(data_cache, course_id):
+    pipe = data_cache.pipeline()
+    pipe.delete(regrade_progress_format.format(course_id=course_id))
+    pipe.hmset(regrade_progress_format.format(course_id=course_id),
+               {'status': 'queued', 'requested_on': str(datetime.utcnow())})
+    pipe.rpush(regrade_request_key, course_id)
+    pipe.execute()
+
+
+def get_regrade_progress(data_cache, course_id):
+    progress = data_cache.hgetall(regrade_progress_format.format(course_id=course_id))
+    return dict((key.decode('utf-8'), value.decode('utf-8')) for key, value in progress.items())
+
+
+def stream_papers(engine, course_id):
+    """Yields the course's papers a chunk at a time from a server-side cursor."""
+    table = ExamTaken.__table__
+    query = select([table.c.id, table.c.other_data, table.c.score, table.c.total_score])\
+        .where(table.c.course_id == course_id)
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        connection.close()
+
+
+def rescore_chunk(answer_key, rows):
+    """
+    :return: a tuple of the rows whose score changed, as bulk UPDATE parameters, the matching
+    (old, new) score pairs and the number of rows that cannot be scored against the new key.
+    """
+    matrix_rows, scored_rows, skipped = [], [], 0
+    for row in rows:
+        try:
+            matrix_rows.append(answers_to_row(answer_key, json.loads(row.other_data)))
+            scored_rows.append(row)
+        except (ValueError, TypeError, OverflowError):
+            skipped += 1
+    if len(scored_rows) == 0:
+        return [], [], skipped
+    scores, total = mark_papers(answer_key, numpy.array(matrix_rows, dtype=numpy.int32))
+    changes, score_pairs = [], []
+    for row, score in zip(scored_rows, scores):
+        score = int(score)
+        if score != row.score or total != row.total_score:
+            changes.append({'row_id': row.id, 'new_score': score, 'new_total': total})
+            score_pairs.append(((row.score, row.total_score), (score, total)))
+    return changes, score_pairs, skipped
+
+
+def regrade_course(data_cache, database_handle, course_id, logger):
+    """
+    Re-marks every stored paper of a course against its current answer key. Each chunk is written
+    back with one executemany UPDATE in its own short transaction, so the table is never held for
+    the whole run; progress is kept in tuq:regrade_progress:<course_id>.
+    """
+    progress_key = regrade_progress_format.format(course_id=course_id)
+    answer_key = AnswerKeyCache(database_handle, data_cache).load(course_id)
+    engine = database_handle.engine
+    table = ExamTaken.__table__
+    update_statement = table.update().where(table.c.id == bindparam('row_id'))\
+        .values(score=bindparam('new_score'), total_score=bindparam('new_total'))
+    paper_count = database_handle.session.query(func.count(ExamTaken.id))\
+        .filter(ExamTaken.course_id == course_id).scalar()
+    data_cache.hmset(progress_key, {'status': 'running', 'total': paper_count, 'processed': 0,
+                                    'changed': 0, 'skipped': 0, 'started_on': str(datetime.utcnow())})
+    for rows in stream_papers(engine, course_id):
+        changes, score_pairs, skipped = rescore_chunk(answer_key, rows)
+        if len(changes) != 0:
+            with engine.begin() as connection:
+                connection.execute(update_statement, changes)
+            record_scores(data_cache, course_id, [old for old, _ in score_pairs], sign=-1)
+            record_scores(data_cache, course_id, [new for _, new in score_pairs])
+        pipe = data_cache.pipeline(transaction=False)
+        pipe.hincrby(progress_key, 'processed', len(rows))
+        pipe.hincrby(progress_key, 'changed', len(changes))
+        pipe.hincrby(progress_key, 'skipped', skipped)
+        pipe.execute()
+
+    # min and max cannot be maintained through deltas, so take them from the table once
+    lowest, highest = database_handle.session.query(func.min(ExamTaken.score), func.max(ExamTaken.score))\
+        .filter(ExamTaken.course_id == course_id).one()
+    pipe = data_cache.pipeline(transaction=False)
+    if lowest is not None:
+        pipe.hmset(course_stats_format.format(course_id=course_id), {'min': lowest, 'max': highest})
+    invalidate_item_analysis(pipe, course_id)
+    pipe.hmset(progress_key, {'status': 'done', 'finished_on': str(datetime.utcnow())})
+    pipe.execute()
+    logger.write('{}: Regraded course {}: {}\n'.format(datetime.utcnow(), course_id,
+                                                      get_regrade_progress(data_cache, course_id)))
+    logger.flush()
+
+
+def main(data_cache, database_handle, logger):
+    while True:
+        _, course_id = data_cache.blpop(regrade_request_key, timeout=0)
+        course_id = int(course_id)
+        try:
+            regrade_course(data_cache, database_handle, course_id, logger)
+        except Exception as exc:
+            database_handle.session.rollback()
+            logger.write('{}: Error regrading course {}: {}\n'.format(datetime.utcnow(), course_id, str(exc)))
+            logger.flush()
+            data_cache.hmset(regrade_progress_format.format(course_id=course_id),
+                             {'status': 'failed', 'error': str(exc), 'finished_on': str(datetime.utcnow())})
+        finally:
+            database_handle.session.remove()
+
+
+if __name__ == '__main__':
+    from init_file import create_app
+    from resources import data_cache
+    from models import db
+    import sys
+
+    parser = argparse.ArgumentParser(description='Re-marks stored papers after an answer key is edited')
+    parser.add_argument('course_ids', type=int, nargs='*',
+                        help='courses to regrade now; without any, wait for requests from the web tier')
+    arguments = parser.parse_args()
+    with create_app().app_context():
+        if len(arguments.course_ids) == 0:
+            main(data_cache, db, open('./logs.txt', 'a'))
+        for course_id in arguments.course_ids:
+            regrade_course(data_cache, db, course_id, sys.stdout)
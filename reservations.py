@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  reservations.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from lua_scripts import LuaScript
+from uuid import uuid4
+import os
+
+
+usernames_key, emails_key, phones_key = ('tuq:usernames', 'tuq:emails', 'tuq:phones')
+reservation_format = 'tuq:reservation:{kind}:{value}'
+# a signup holds its identifiers while it writes the user row; an admin request until the broker,
+# which polls every minute, saves it or parks it and releases them. An hour covers a broker restart
+# without keeping the identifiers blocked for long if the request is lost
+signup_reservation_ttl = int(os.environ.get('SIGNUP_RESERVATION_TTL', 60))
+admin_reservation_ttl = int(os.environ.get('ADMIN_RESERVATION_TTL', 60 * 60))
+RESERVED, USERNAME_TAKEN, EMAIL_TAKEN, PHONE_TAKEN = (0, 1, 2, 3)
+
+# KEYS: the usernames, emails and phones sets, then the reservation key of each identifier
+# ARGV: username, email, phone ('' when there is none), token, ttl
+# Returns RESERVED, or which identifier is registered or held by another signup
+reserve_script = LuaScript("""
+for i = 1, 3 do
+    if ARGV[i] ~= '' then
+        if redis.call('SISMEMBER', KEYS[i], ARGV[i]) == 1 then
+            return i
+        end
+        local holder = redis.call('GET', KEYS[i + 3])
+        if holder and holder ~= ARGV[4] then
+            return i
+        end
+    end
+end
+for i = 1, 3 do
+    if ARGV[i] ~= '' then
+        redis.call('SET', KEYS[i + 3], ARGV[4], 'EX', ARGV[5])
+    end
+end
+return 0
+""")
+
+# KEYS: reservation keys; ARGV: token. Drops only the reservations the token still holds.
+release_script = LuaScript("""
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[1] then
+        redis.call('DEL', KEYS[i])
+    end
+end
+return 0
+""")
+
+
+def reservation_keys(username, email, phone):
+    return [reservation_format.format(kind='username', value=username),
+            reservation_format.format(kind='email', value=email),
+            reservation_format.format(kind='phone', value=phone or '')]
+
+
+def reserve_identity(data_cache, username, email, phone, ttl=signup_reservation_ttl, token=None):
+    """
+    Checks that none of the identifiers is registered or being registered, and holds all of them
+    for `ttl` seconds, in one atomic round trip.
+    :return: a tuple of RESERVED or the *_TAKEN code of the first conflict, and the reservation token.
+    """
+    token = token or uuid4().hex
+    keys = [usernames_key, emails_key, phones_key] + reservation_keys(username, email, phone)
+    status = reserve_script(data_cache, keys, [username, email, phone or '', token, ttl])
+    return int(status), token
+
+
+def release_identity(data_cache, username, email, phone, token):
+    release_script(data_cache, reservation_keys(username, email, phone), [token])
+
+
+def confirm_identity(pipe, username, email, phone, token):
+    """Registers the identifiers for good once the user row exists, and drops their reservation."""
+    pipe.sadd(usernames_key, username)
+    pipe.sadd(emails_key, email)
+    if phone:
+        pipe.sadd(phones_key, phone)
+    release_identity(pipe, username, email, phone, token)
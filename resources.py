@@ -9,8 +9,11 @@ from flask import url_for, jsonify
 from flask_login import current_user
 from functools import wraps, partial
 from models import Course
+from paper_queue import submit_paper
+from email_queue import enqueue_confirmation
 import os
 import redis
+import time
 
 
 ERROR, SUCCESS = (0, 1)
@@ -24,17 +27,22 @@ EXPIRY_INTERVAL = 60 * 60 * 12  # 12hours
 
 cache_pass,port_number=os.environ.get('redis_pass'),int(os.environ.get('redis_port'))
 data_cache = redis.StrictRedis(password=cache_pass,port=port_number)
-pending_email_keys = 'tuq:pending_confirmation_emails'
-pending_paper_keys = 'tuq:pending_papers'
 well_known_courses = 'tuq:known_courses'
+# opt-in: score submissions inside the request when the answer key is cached and load is low
+INLINE_MARKING = os.environ.get('INLINE_MARKING', '0') == '1'
+INLINE_MAX_QUEUE_DEPTH = int(os.environ.get('INLINE_MAX_QUEUE_DEPTH', 50))
+INLINE_MAX_LATENCY = float(os.environ.get('INLINE_MAX_LATENCY', 0.25))  # seconds
+INLINE_COOL_DOWN = 5  # seconds
 
 
 def send_confirmation_message(user_email, user_id, fullname ):
-    data_cache.hset(pending_email_keys, user_email, '{} %% {}'.format(user_id,fullname))
+    pipe = data_cache.pipeline()
+    enqueue_confirmation(pipe, user_email, user_id, fullname)
+    pipe.execute()
 
 
-def submit_paper_for_marking(user_email,data_string):
-    data_cache.hset(pending_paper_keys, user_email, data_string)
+def submit_paper_for_marking(user_id, course_id, submission_id, data_string):
+    return submit_paper(data_cache, data_string, user_id, course_id, submission_id)
 
 
 def urlify(course_owner, repository, expiry):
@@ -103,18 +111,27 @@ def administrator_required(f):
     return decorated_func
 
 
-class MyJSONObjectWriter():
-    def __init__(self):
-        self.buffer = ''
-
-    def write(self, new_string):
-        self.buffer += new_string
-
-    def get_buffer(self):
-        return self.buffer
-
-    def __repr__(self):
-        return self.get_buffer()
+class InlineMarkingGate():
+    """
+    Decides whether a submission may be marked inside the request. Inline marking is refused
+    while the course's queue is deeper than `max_queue_depth`, or for `cool_down` seconds after
+    the moving average of inline marking time went above `max_latency`.
+    """
+    def __init__(self, max_queue_depth, max_latency, cool_down):
+        self.max_queue_depth = max_queue_depth
+        self.max_latency = max_latency
+        self.cool_down = cool_down
+        self.average_latency = 0.0
+        self.tripped_at = None
+
+    def allows(self, queue_depth):
+        if queue_depth > self.max_queue_depth:
+            return False
+        return self.tripped_at is None or (time.time() - self.tripped_at) >= self.cool_down
+
+    def record(self, seconds):
+        self.average_latency = 0.8 * self.average_latency + 0.2 * seconds
+        self.tripped_at = time.time() if self.average_latency > self.max_latency else None
 
 
 class Links():
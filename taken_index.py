@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  taken_index.py
+#
+#  Copyright 2017 Joshua <ogunyinkajoshua@gmail.com>
+
+from models import db, ExamTaken
+from paper_queue import course_takers_format, paper_stream, stream_shards, entries_to_papers
+from payloads import unpack, PAPER
+from rebuild_cache import KeySwap, streamed
+from datetime import datetime
+import argparse
+
+
+def course_takers_key(course_id):
+    return course_takers_format.format(course_id=course_id)
+
+
+def has_taken(data_cache, course_id, user_id):
+    return data_cache.sismember(course_takers_key(course_id), user_id)
+
+
+def mark_as_taken(data_cache, course_id, user_id):
+    """:return: False if the user was already recorded as having taken the course."""
+    return data_cache.sadd(course_takers_key(course_id), user_id) == 1
+
+
+def release_taken(data_cache, course_id, user_id):
+    data_cache.srem(course_takers_key(course_id), user_id)
+
+
+def queued_takers(data_cache):
+    pipe = data_cache.pipeline(transaction=False)
+    for shard in range(stream_shards):
+        pipe.xrange(paper_stream(shard))
+    for entries in pipe.execute():
+        for entry_id, data_string in entries_to_papers(entries):
+            try:
+                paper = unpack(PAPER, data_string)
+            except ValueError:
+                continue  # the marker dead-letters it; it never reaches exams_taken
+            yield paper.get('course_id'), paper.get('user_id')
+
+
+def rebuild_taken_index(data_cache, database_handle):
+    """
+    Repopulates every tuq:course_takers:* set from exams_taken plus the papers still queued; like
+    the marker, it leaves out papers parked in tuq:error_unmarked_papers. Rows are streamed with
+    a server-side cursor through a KeySwap. A submission made while it runs may be dropped by the
+    swap, so run it outside exam windows.
+    """
+    swap = KeySwap(data_cache)
+    for course_id, user_id in streamed(database_handle.session.query(ExamTaken.course_id, ExamTaken.participant_id)):
+        swap.write('sadd', course_takers_key(course_id), user_id)
+    for course_id, user_id in queued_takers(data_cache):
+        swap.write('sadd', course_takers_key(course_id), user_id)
+    return swap.swap(data_cache.scan_iter(match=course_takers_format.format(course_id='*')))
+
+
+if __name__ == '__main__':
+    from init_file import create_app
+    from resources import data_cache
+
+    parser = argparse.ArgumentParser(description='Maintains the Redis index of who has taken which course')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.parse_args()
+    with create_app().app_context():
+        print('{}: Rebuilt takers of {} courses'.format(datetime.utcnow(), rebuild_taken_index(data_cache, db)))
@@ -5,19 +5,37 @@
 
 
 from flask import Blueprint, jsonify, request, redirect, send_file, safe_join, render_template, flash, session
+from flask import current_app
 from werkzeug.exceptions import BadRequest
 from datetime import date, datetime
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
 from models import db, User, Course, ExamTaken, Department, Repository, DEFAULT_DISPLAY_PICTURE
 from resources import urlify, get_data, respond_back, jsonify_courses, administrator_required, Links, coursify
-from resources import ERROR, SUCCESS, UPLOAD_DIR, list_courses_data, MyJSONObjectWriter, EXPIRY_INTERVAL
-from resources import send_confirmation_message, submit_paper_for_marking, url_for, well_known_courses, jsonify_departments
+from resources import ERROR, SUCCESS, UPLOAD_DIR, list_courses_data, EXPIRY_INTERVAL
+from resources import send_confirmation_message, submit_paper_for_marking, url_for
 from forms import data_cache, AdminRequestForm
+from resources import InlineMarkingGate, INLINE_MARKING, INLINE_MAX_QUEUE_DEPTH, INLINE_MAX_LATENCY, INLINE_COOL_DOWN
+from answer_keys import AnswerKeyCache, AnswerKeyWarmer, invalidate_answer_key, mark_paper
+from paper_queue import paper_stream, shard_for_course, submission_key_format, submission_ttl, ALREADY_TAKEN
+from paper_queue import inline_marking_claim, inline_claim_ttl
+from taken_index import mark_as_taken, release_taken
+from course_stats import record_scores, get_course_stats
+from item_analysis import get_item_analysis, invalidate_item_analysis
+from regrader import request_regrade, get_regrade_progress
+from queue_metrics import record_enqueued, ADMIN_REQUESTS
+from payloads import pack, PAPER, ADMIN_REQUEST
+from password_hasher import password_hasher, HasherBusy
+from reservations import reserve_identity, release_identity, confirm_identity
+from reservations import RESERVED, USERNAME_TAKEN, EMAIL_TAKEN, PHONE_TAKEN
+from email_queue import enqueue_confirmation
+from course_cache import CourseCache, course_metadata, invalidate_course
 from random import randint
+from uuid import uuid4
 from flask_login import login_required, login_user, current_user
 from flask_uploads import UploadSet, UploadNotAllowed, IMAGES, TEXT, DOCUMENTS, DATA
-import json
+import json_codec
 import os
+import time
 
 RAW_FILES = TEXT + DOCUMENTS + DATA
 EXT = '.silt'
@@ -34,9 +52,27 @@ known_clients = ('TuqOnPC', 'TuqOnMobile')
 all_course_ranks = 'tuq:all_course_rank'
 deleted_repo_keys = 'tuq:deleted_repos'
 deleted_course_keys = 'tuq:deleted_courses'
+# once a paper is marked inline its submission key holds the result; queued papers store their
+# stream entry id there instead
+inline_result_prefix = 'scored:'
 
 
 internal_url_for = url_for
+answer_keys = AnswerKeyCache(db, data_cache)
+answer_key_warmer = AnswerKeyWarmer(answer_keys)
+inline_gate = InlineMarkingGate(INLINE_MAX_QUEUE_DEPTH, INLINE_MAX_LATENCY, INLINE_COOL_DOWN)
+
+
+def load_course_metadata(course_id):
+    course = db.session.query(Course).filter_by(id=course_id).first()
+    if course is None:
+        return None
+    owner = db.session.query(User.username).join(Repository, Repository.owner_id == User.id)\
+        .filter(Repository.id == course.repo_id).first()
+    return course_metadata(course, owner.username if owner is not None else None)
+
+
+course_cache = CourseCache(data_cache, load_course_metadata)
 
 def error_response(message):
     return respond_back(ERROR, message)
@@ -59,10 +95,7 @@ def safe_makedir(parent_path, path, paths=''):
 
 def rank_courses_result(courses):
     data = []
-    # courses = json.loads(courses)
     for course in courses:
-        if course is None: continue
-        course = json.loads(course)
         if course is None: continue
         course_id = long(course.get('id'))
         data.append({
@@ -99,6 +132,9 @@ def main_route():
         'delete_course': url_for('auth.delete_course_route', _external=True),
         'edit_course': url_for('auth.edit_course_route', _external=True),
         'list_partakers': url_for('auth.list_partakers_route', _external=True),
+        'course_statistics': url_for('auth.course_statistics_route', _external=True),
+        'item_analysis': url_for('auth.item_analysis_route', _external=True),
+        'regrade_progress': url_for('auth.regrade_progress_route', _external=True),
         'delete_score' : url_for('auth.delete_exam_info_route', _external=True)
     }
     return jsonify({'status': SUCCESS, 'endpoints': endpoints})
@@ -202,6 +238,72 @@ def get_question_route():
     return send_file(course.quiz_filename)
 
 
+def mark_inline(course_id, owner_id, date_taken, answers, other_data, submission_id):
+    """
+    Scores a submission inside the request when the course's answer key is already cached in this
+    worker and the markers are keeping up. A retry with the same submission id gets the score of
+    the first attempt back.
+    :return: a tuple of score and total, ALREADY_TAKEN, or None when the paper should be queued instead.
+    """
+    submission_key = submission_key_format.format(user_id=current_user.id, course_id=course_id,
+                                                  submission_id=submission_id)
+    if not data_cache.set(submission_key, inline_marking_claim, nx=True, ex=inline_claim_ttl):
+        existing = (data_cache.get(submission_key) or b'').decode('utf-8')
+        if existing.startswith(inline_result_prefix):
+            score, total = existing[len(inline_result_prefix):].split(':')
+            return int(score), int(total)
+        return None  # queued, or still being marked: the queue answers it
+    result = None
+    try:
+        result = score_inline(course_id, owner_id, date_taken, answers, other_data)
+        return result
+    finally:
+        if result is None or result == ALREADY_TAKEN:
+            data_cache.delete(submission_key)
+        else:
+            data_cache.set(submission_key, '{}{}:{}'.format(inline_result_prefix, result[0], result[1]),
+                           ex=submission_ttl)
+
+
+def score_inline(course_id, owner_id, date_taken, answers, other_data):
+    answer_keys.refresh_versions(max_age=1)
+    answer_key = answer_keys.peek(course_id)
+    if answer_key is None:
+        answer_key_warmer.warm(current_app._get_current_object(), course_id)
+        return None
+    if not inline_gate.allows(data_cache.xlen(paper_stream(shard_for_course(course_id)))):
+        return None
+    if not mark_as_taken(data_cache, course_id, current_user.id):
+        return ALREADY_TAKEN
+    started = time.time()
+    try:
+        score, total = mark_paper(answer_key, answers)
+        exam_taken = ExamTaken(course_id=course_id, participant_id=current_user.id, date_taken=date_taken,
+                               other_data=other_data, score=score, course_owner=owner_id, total_score=total)
+        db.session.add(exam_taken)
+        db.session.commit()
+    except (ValueError, TypeError, OverflowError):
+        db.session.rollback()
+        release_taken(data_cache, course_id, current_user.id)
+        return None  # let the marker dead-letter it as usual
+    except IntegrityError:
+        # a retry queued while this was marked got stored first; the student keeps the place
+        db.session.rollback()
+        inline_gate.record(time.time() - started)
+        return None
+    except Exception as exc:
+        print('Inline marking failed: {}'.format(str(exc)))
+        db.session.rollback()
+        release_taken(data_cache, course_id, current_user.id)
+        inline_gate.record(time.time() - started)
+        return None
+    inline_gate.record(time.time() - started)
+    data_cache.zincrby(all_course_ranks, 1, course_id)
+    record_scores(data_cache, course_id, [(score, total)])
+    invalidate_item_analysis(data_cache, course_id)
+    return score, total
+
+
 # student exam solution data( sesd )
 @auth.route('/p-sesd', methods=['POST'])
 @login_required
@@ -218,20 +320,24 @@ def post_secure_sesd_route():
         repo_owner = db.session.query(User).filter_by(username=owner).first()
         if course_id is None or repo_owner is None:
             return respond_back(ERROR,'This course does not exist')
-        course_taken = db.session.query(ExamTaken).filter_by(course_id=course_id,
-                                participant_id=current_user.id).first()
-        if course_taken is not None:
-            return error_response('you have already taken this examination')
-        # needed to verify JSON object's correctness for the answer
-        answer_object = MyJSONObjectWriter()
-        json.dump(answer_pair, answer_object, skipkeys=True, indent=2, separators=(',', ': '))
-        other_data = answer_object.get_buffer()
-        
+        # clients send the same submission id when retrying, so a retry is not queued or marked twice
+        submission_id = data.get('submission_id') or request.headers.get('Idempotency-Key') or uuid4().hex
+        if INLINE_MARKING:
+            result = mark_inline(course_id, repo_owner.id, date_taken, answer_pair, json_codec.dumps(answer_pair),
+                                 submission_id)
+            if result == ALREADY_TAKEN:
+                return error_response('you have already taken this examination')
+            if result is not None:
+                return jsonify({'status': SUCCESS, 'detail': 'OK', 'score': result[0], 'total': result[1]})
+
         solution_data = { 'user_id': current_user.id, 'owner_id': repo_owner.id,
-                        'course_id': course_id, 'data': other_data, 
-                        'date_taken': date_taken }
+                        'course_id': course_id, 'answers': answer_pair,
+                        'date_taken': date_taken, 'submission_id': submission_id }
 
-        submit_paper_for_marking(current_user.email, json.dumps(solution_data))
+        status, entry_id = submit_paper_for_marking(current_user.id, course_id, submission_id,
+                                                    pack(PAPER, solution_data))
+        if status == ALREADY_TAKEN:
+            return error_response('you have already taken this examination')
         return success_response('OK')
     except BadRequest:
         return error_response('No data was specified')
@@ -249,8 +355,15 @@ def login_route():
         student = db.session.query(User).filter_by(username=username).first()
         if student is None:
             return jsonify({'status': ERROR, 'detail': 'Invalid login detail'})
-        if not student.verify_password(password):
+        try:
+            verified, new_hash = password_hasher.verify(student.password_hash, password)
+        except HasherBusy:
+            return error_response('The server is busy, please try again')
+        if not verified:
             return jsonify({'status': ERROR, 'detail': 'Invalid username or password'})
+        if new_hash is not None:
+            student.password_hash = new_hash
+            db.session.commit()
         login_user(student, False)
         return jsonify({'status': SUCCESS, 'detail': current_user.fullname,
             'dp_link': current_user.display_picture,
@@ -259,6 +372,11 @@ def login_route():
         return error_response('Invalid login request received.')
 
 
+identity_taken_messages = {USERNAME_TAKEN: 'The username has been registered',
+                           EMAIL_TAKEN: 'The email address has been registered',
+                           PHONE_TAKEN: 'The mobile number has been registered'}
+
+
 @main.route('/signup', methods=['POST'])
 def signup_route():
     try:
@@ -274,27 +392,32 @@ def signup_route():
         
         if not all( ( name,address,email,username,password, ) ):
             return respond_back(ERROR,'Missing data member')
-        if data_cache.sismember('tuq:usernames',username):
-            return error_response('The username has been registered')
-        if data_cache.sismember('tuq:emails',email):
-            return respond_back(ERROR,'The email address has been registered')
-        if phone_number is not None and len(phone_number) != 0 and data_cache.sismember('tuq:phones',phone_number):
-            return error_response('The mobile number has been registered')
-        user = User(username=username, fullname=name, email=email,alias=username,password=password,
-                    address=address,role=User.NORMAL_USER,display_picture=DEFAULT_DISPLAY_PICTURE,
-                    phone_number=phone_number,is_active_premium=False, date_of_registration=str(datetime.utcnow()))
+        status, reservation = reserve_identity(data_cache, username, email, phone_number)
+        if status != RESERVED:
+            return error_response(identity_taken_messages[status])
         try:
+            password_hash = password_hasher.hash(password)
+            user = User(username=username, fullname=name, email=email,alias=username,password_hash=password_hash,
+                        address=address,role=User.NORMAL_USER,display_picture=DEFAULT_DISPLAY_PICTURE,
+                        phone_number=phone_number,is_active_premium=False, date_of_registration=str(datetime.utcnow()))
             db.session.add(user)
             db.session.commit()
+        except HasherBusy:
+            release_identity(data_cache, username, email, phone_number, reservation)
+            return error_response('The server is busy, please try again')
         except InvalidRequestError as invalid_request_err:
             print(invalid_request_err)
+            db.session.rollback()
+            release_identity(data_cache, username, email, phone_number, reservation)
             return error_response('User detail already exist')
-        data_cache.sadd('tuq:emails',email)
-        data_cache.sadd('tuq:usernames',username)
-        if phone_number is not None:
-            data_cache.sadd('tuq:phones',phone_number)
-        
-        send_confirmation_message(email, user.id, name)
+        except Exception:
+            db.session.rollback()
+            release_identity(data_cache, username, email, phone_number, reservation)
+            raise
+        pipe = data_cache.pipeline()
+        confirm_identity(pipe, username, email, phone_number, reservation)
+        enqueue_confirmation(pipe, email, user.id, name)
+        pipe.execute()
         return respond_back(SUCCESS,'A confirmation message has been sent to your email')
     except Exception as e:
         print(e)
@@ -335,24 +458,10 @@ def get_result_route():
     all_results = db.session.query(ExamTaken).filter_by(participant_id=current_user.id).all()
     data = []
     for result in all_results:
-        course_info = data_cache.hget(well_known_courses, result.course_id)
-        course_info_obj = None
-        if course_info is None:
-            course_info = db.session.query(Course).filter_by(id=result.course_id).first()
-            if course_info is None:  # still none?
-                print('We have an issue with {}'.format(result.course_id))
-                continue
-            #  otherwise cache it
-            owner = db.session.query(User).filter_by(id=result.course_owner).first()
-            course_cache = {'name': course_info.name, 'id': course_info.id,
-                            'owner': course_info.lecturer_in_charge, 'owner_username': owner.username,
-                            'question': course_info.quiz_filename, 'code': course_info.code, 
-                            'solution': course_info.solution_filename, 'icon': course_info.logo_location}
-            print(course_cache)
-            data_cache.hset(well_known_courses,result.course_id, json.dumps(course_cache))
-            course_info_obj = course_cache  # no need to recheck the data_cache, just use the data
-        if course_info_obj is None:  # if it has not been loaded yet, use the data obtained
-            course_info_obj = json.loads(course_info)
+        course_info_obj = course_cache.get(result.course_id)
+        if course_info_obj is None:
+            print('We have an issue with {}'.format(result.course_id))
+            continue
         data.append({'name': course_info_obj['name'], 'score': result.score, 'date': result.date_taken,
                      'total': result.total_score, 'code': course_info_obj['code'], 
                      'owner': course_info_obj['owner']})
@@ -437,11 +546,16 @@ def update_course(data, user, database_handle):
     except AttributeError:
         raise ValueError('Expects a valid data in the departments')
 
+    try:
+        with open(course_to_use.solution_filename, mode='rt') as previous:
+            previous_solution = json_codec.load(previous)
+    except (IOError, ValueError):
+        previous_solution = None
     try:
         with open(course_to_use.quiz_filename, mode='wt') as out:
-            json.dump(question, out, sort_keys=True, indent=4, separators=(',', ': '))
+            json_codec.dump(question, out, sort_keys=True)
         with open(course_to_use.solution_filename, mode='wt') as out:
-            json.dump(solution, out, indent=True, separators=(',', ': '))
+            json_codec.dump(solution, out)
     except ValueError:
         raise ValueError( 'Invalid JSON Document for question')
     course_to_use.name = course_name
@@ -457,11 +571,11 @@ def update_course(data, user, database_handle):
     repository_to_use.courses.append(course_to_use)
     database_handle.session.add(course_to_use)
     db.session.commit()
-    course_cache = {'name': course_to_use.name, 'id': course_to_use.id,
-                    'owner': course_to_use.lecturer_in_charge, 'icon': icon_location,
-                    'code': course_to_use.code, 'solution': course_to_use.solution_filename,
-                    'question': course_to_use.quiz_filename}
-    data_cache.hset(well_known_courses, course_to_use.id, json.dumps(course_cache))
+    invalidate_course(data_cache, course_to_use.id)
+    invalidate_answer_key(data_cache, course_to_use.id)
+    invalidate_item_analysis(data_cache, course_to_use.id)
+    if previous_solution != solution:
+        request_regrade(data_cache, course_to_use.id)
 
 
 @auth.route('/admin_add_course', methods=['POST'])
@@ -525,9 +639,9 @@ def admin_add_course_route():
             solution_fn = safe_join(dir_path, 'solutions_'+ filename)
 
             with open(full_path, mode='wt') as out:
-                json.dump(question, out, sort_keys=True, indent=4, separators=(',', ': '))
+                json_codec.dump(question, out, sort_keys=True)
             with open( solution_fn, mode='wt') as out:
-                json.dump(solution, out, indent=True, separators=(',', ': '))
+                json_codec.dump(solution, out)
         except ValueError:
             return error_response('Invalid JSON Document for question')
         course = Course(name=course_name, code=course_code, lecturer_in_charge=personnel_in_charge,
@@ -543,11 +657,7 @@ def admin_add_course_route():
         db.session.add(current_user)
 
         db.session.commit()
-        course_cache = {'name': course.name, 'id': course.id, 'owner': course.lecturer_in_charge,
-                        'code': course.code, 'solution': course.solution_filename,
-                        'icon': course.logo_location, 'owner_username': current_user.username,
-                        'question': course.quiz_filename}
-        data_cache.hset(well_known_courses, course.id, json.dumps(course_cache))
+        invalidate_course(data_cache, course.id)
         return success_response('New course added successfully')
     except BadRequest:
         return error_response('Bad request')
@@ -583,7 +693,7 @@ def edit_course_route():
                     'date_to_be_held': str(course.date_to_be_held), 'icon': course.logo_location,
                     'duration': course.duration_in_minutes, 'approach': course.answers_approach,
                     'randomize': course.randomize_questions, 'expires_on': str(course.expires_on),
-                    'question': json.load(question_file), 'answers': json.load(answer_file)
+                    'question': json_codec.load(question_file), 'answers': json_codec.load(answer_file)
                     }
             question_file.close()
             answer_file.close()
@@ -634,8 +744,7 @@ def most_ranked_courses_route():
         most_ranked = map(lambda data: long(data), most_ranked)
     except ValueError:
         return error_response('Unable to service request')
-    courses = data_cache.hmget(well_known_courses, most_ranked)
-    return rank_courses_result(courses)
+    return rank_courses_result(course_cache.get_many(list(most_ranked)))
 
 
 @auth.route('/course_info')
@@ -646,14 +755,14 @@ def course_info_route():
     course_id = Course.get_course_id(course_token, EXPIRY_INTERVAL*2)
     if not all((course_id, course_owner, len(course_owner) > 0 )):
         return error_response('Invalid course specified')
-    course = db.session.query(Course).filter_by(id=long(course_id)).first()
+    course = course_cache.get(course_id)
     if course is None:
         return error_response('No course with that ID exists')
-    course_detail = {'paper_name': course.name, 'paper_code': course_token, 'icon': course.logo_location,
-            'duration': course.duration_in_minutes, 'instructor': course.lecturer_in_charge,
-            'departments': jsonify_departments(course.departments), 'randomize': course.randomize_questions,
+    course_detail = {'paper_name': course['name'], 'paper_code': course_token, 'icon': course['icon'],
+            'duration': course['duration'], 'instructor': course['owner'],
+            'departments': course['departments'], 'randomize': course['randomize'],
             'owner': course_owner, 'reply_to': url_for('auth.post_secure_sesd_route', _external=True),
-            'url': url_for('auth.get_paper_route', url=coursify(course.id, course.quiz_filename),
+            'url': url_for('auth.get_paper_route', url=coursify(course['id'], course['question']),
                 _external=True)
     }
     return success_response(course_detail)
@@ -670,8 +779,13 @@ def delete_exam_info_route():
         exam = db.session.query(ExamTaken).filter_by(id=reference_id).first()
         if not exam:
             return error_response('No course with that reference ID exists')
+        course_id, participant_id = exam.course_id, exam.participant_id
+        score, total = exam.score, exam.total_score
         db.session.delete(exam)
         db.session.commit()
+        release_taken(data_cache, course_id, participant_id)
+        record_scores(data_cache, course_id, [(score, total)], sign=-1)
+        invalidate_item_analysis(data_cache, course_id)
         return success_response('Successful')
     except ValueError as val_error:
         print('ValueError: {}\n'.format(str(val_error)))
@@ -713,6 +827,62 @@ def list_partakers_route():
         return error_response('Unable to process requests')
 
 
+def owned_course(course_id, repo_name):
+    course = db.session.query(Course).filter_by(id=course_id).first()
+    if course is None:
+        return None
+    repo = db.session.query(Repository).filter_by(owner_id=current_user.id, repo_name=repo_name).first()
+    if repo is None or course.repo_id != repo.id:
+        return None
+    return course
+
+
+@auth.route('/course_statistics')
+@login_required
+@administrator_required
+def course_statistics_route():
+    try:
+        course_id = long(request.args.get('course_id'))
+        if owned_course(course_id, request.args.get('repository')) is None:
+            return error_response('Unable to locate the course')
+        return success_response(get_course_stats(data_cache, course_id))
+    except (ValueError, TypeError) as val_error:
+        print('ValueError: {}\n'.format(str(val_error)))
+        return error_response('Invalid parameters')
+
+
+@auth.route('/item_analysis')
+@login_required
+@administrator_required
+def item_analysis_route():
+    try:
+        course_id = long(request.args.get('course_id'))
+        if owned_course(course_id, request.args.get('repository')) is None:
+            return error_response('Unable to locate the course')
+        answer_keys.refresh_versions(max_age=1)
+        return success_response(get_item_analysis(data_cache, db, answer_keys.get(course_id)))
+    except (ValueError, TypeError) as val_error:
+        print('ValueError: {}\n'.format(str(val_error)))
+        return error_response('Invalid parameters')
+    except Exception as exc:
+        print('GeneralException: {}\n'.format(str(exc)))
+        return error_response('Unable to process requests')
+
+
+@auth.route('/regrade_progress')
+@login_required
+@administrator_required
+def regrade_progress_route():
+    try:
+        course_id = long(request.args.get('course_id'))
+        if owned_course(course_id, request.args.get('repository')) is None:
+            return error_response('Unable to locate the course')
+        return success_response(get_regrade_progress(data_cache, course_id))
+    except (ValueError, TypeError) as val_error:
+        print('ValueError: {}\n'.format(str(val_error)))
+        return error_response('Invalid parameters')
+
+
 @auth.route('/get_courses_from_repo')
 @login_required
 @administrator_required
@@ -808,8 +978,9 @@ def delete_course_route():
         course_id = course.id
         db.session.delete(course)
         db.session.commit()
-        data_cache.hdel(well_known_courses, course_id)
+        invalidate_course(data_cache, course_id)
         data_cache.rpush(deleted_course_keys, course_id)
+        invalidate_answer_key(data_cache, course_id)
         return success_response('Course removed successfully')
     except Exception as e:
         print(e)
@@ -843,15 +1014,24 @@ def admin_signup_route():
     links.index_url = url_for('web.index_page_route',_external=True)
     form = AdminRequestForm()
     if form.validate_on_submit():
+        try:
+            password_hash = password_hasher.hash(form.password.data)
+        except HasherBusy:
+            release_identity(data_cache, form.username.data, form.email.data, form.phone_number.data,
+                             form.reservation)
+            flash('The server is busy, please try again')
+            return render_template('admin_register.html', form=form, links=links)
         submission_info = {'username': form.username.data, 'fullname': form.full_name.data,
                            'address': form.address.data, 'email': form.email.data,
                            'nationality': form.nationality.data, 'alias': form.display_name.data,
-                           'mobile': form.phone_number.data, 'password': form.password.data }
-        json_writer = MyJSONObjectWriter()
-        json.dump(submission_info,json_writer, skipkeys=True, indent=2, separators=(',', ': '))
-        data_string = json_writer.get_buffer()
-
-        data_cache.hset('tuq:admin_requests', form.username.data, data_string)
+                           'mobile': form.phone_number.data, 'password_hash': password_hash,
+                           'reservation': form.reservation }
+        data_string = pack(ADMIN_REQUEST, submission_info)
+
+        pipe = data_cache.pipeline()
+        pipe.hset('tuq:admin_requests', form.username.data, data_string)
+        record_enqueued(pipe, ADMIN_REQUESTS, form.username.data)
+        pipe.execute()
         session['name']=form.full_name.data
         return redirect(url_for('web.submission_made_route', _external=True))
     else: